@@ -0,0 +1,57 @@
+"""Report where the start-up time of the bot goes.
+
+Runs `python -X importtime` on a module of the bot and prints the imports with
+the highest cumulative time. Run it from the repository root:
+
+    python bench/importtime.py app --top 25
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def import_times(module):
+    """Imports module in a fresh interpreter and returns (self_us, cumulative_us, depth, name)."""
+    env = dict(os.environ, PYTHONPATH=str(ROOT / "src"))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise SystemExit(result.stderr)
+    times = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            times.append((int(self_us), int(cumulative_us), (len(indent) - 1) // 2, name))
+    return times
+
+
+def report(module, top=20, depth=None):
+    times = import_times(module)
+    total = sum(self_us for self_us, _, _, _ in times)
+    if depth is not None:
+        times = [t for t in times if t[2] <= depth]
+    print(f"Importing {module} took {total / 1000:.1f} ms ({len(times)} modules)\n")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for self_us, cumulative_us, level, name in sorted(times, key=lambda t: -t[1])[:top]:
+        print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {'  ' * level}{name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("module", nargs="?", default="app")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=None, help="only show imports up to this nesting level")
+    args = parser.parse_args()
+    report(args.module, args.top, args.depth)
@@ -0,0 +1,71 @@
+"""Post recorded Telegram updates to the webhook of a running bot.
+
+Start the bot with `mode = webhook` and post a file with one update or a list
+of updates, as Telegram would:
+
+    python bench/post_updates.py bench/updates/text_burst.json --concurrency 4
+
+Update ids and chat ids are sent as recorded, so use a recording of the chat
+configured in config.conf.
+"""
+import argparse
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from pyhocon import ConfigFactory
+
+
+def webhook_url(config):
+    webhook = config.get("webhook")
+    listen = webhook.get("listen", "0.0.0.0")
+    host = "127.0.0.1" if listen == "0.0.0.0" else listen
+    path = webhook.get("path", "telegram").strip("/")
+    return f"http://{host}:{webhook.get('port', 8443)}/{path}"
+
+
+def post_update(url, update, secret_token=None):
+    """Posts one update, returns the http status and the time it took in seconds."""
+    headers = {"Content-Type": "application/json"}
+    if secret_token:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret_token
+    request = urllib.request.Request(
+        url, data=json.dumps(update).encode(), headers=headers, method="POST"
+    )
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - start
+
+
+def load_updates(paths):
+    updates = []
+    for path in paths:
+        data = json.loads(Path(path).read_text())
+        updates.extend(data if isinstance(data, list) else [data])
+    return updates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--config", default="config/config.conf")
+    parser.add_argument("--url", default=None, help="defaults to the webhook in the config")
+    parser.add_argument("--concurrency", type=int, default=1)
+    args = parser.parse_args()
+
+    config = ConfigFactory.parse_file(args.config)
+    url = args.url or webhook_url(config)
+    secret_token = config.get("webhook.secret_token", None)
+    updates = load_updates(args.files)
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(lambda u: post_update(url, u, secret_token), updates))
+    for update, (status, seconds) in zip(updates, results):
+        print(f"update {update.get('update_id')}: {status} in {seconds * 1000:.1f} ms")
+    failed = sum(status != 200 for status, _ in results)
+    print(f"{len(updates) - failed}/{len(updates)} updates accepted by {url}")
@@ -0,0 +1,461 @@
+"""Replay Telegram update streams against the real handlers of the bot.
+
+The application from app.build_application runs with a stand-in for the bot
+api that records every outgoing call, and with a fake OpenAI server. Updates
+come from recorded files or from a generated scenario and are fed at a fixed
+rate. Run it from the repository root:
+
+    python bench/replay.py --scenario mixed --rate 20
+    python bench/replay.py --updates bench/updates/text_burst.json --webhook
+
+With --webhook the updates are posted over http to the webhook server of the
+bot, as Telegram would, instead of being put into its update queue. It
+reports throughput, handler latency, event-loop lag, the outcome and duration
+of background jobs and whether every message and photo ended up exactly once
+in the diary, and exits with 1 otherwise. --check runs a few small scenarios
+and asserts on their results.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT / "src"))
+os.chdir(ROOT)
+
+from pyhocon import ConfigFactory  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+from post_updates import post_update, webhook_url  # noqa: E402
+
+CHAT_ID = 4242
+USER = {"id": 42, "is_bot": False, "first_name": "Bench"}
+EMBEDDING_SIZE = 256
+
+
+# fake OpenAI server
+
+
+class FakeOpenAI(BaseHTTPRequestHandler):
+    latency = 0.0
+    calls = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]
+        FakeOpenAI.calls[endpoint] = FakeOpenAI.calls.get(endpoint, 0) + 1
+        time.sleep(self.latency)
+        if endpoint == "embeddings":
+            inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            result = {
+                "object": "list",
+                "model": body["model"],
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": fake_embedding(text)}
+                    for i, text in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": 1, "total_tokens": 1},
+            }
+        else:
+            result = {
+                "id": "bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": "stop",
+                        "message": {"role": "assistant", "content": "Bench report."},
+                    }
+                ],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            }
+        data = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def fake_embedding(text):
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    return np.random.default_rng(seed).normal(size=EMBEDDING_SIZE).round(5).tolist()
+
+
+def start_fake_openai(latency):
+    FakeOpenAI.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "bench"
+    return server
+
+
+# stand-in for the bot api
+
+
+class RecordingRequest(BaseRequest):
+    """Answers bot api calls locally and records them."""
+
+    def __init__(self, image):
+        self.calls = []
+        self.image = image
+        self._message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, chat_id, **fields):
+        self._message_id += 1
+        chat = {"id": int(chat_id), "type": "private", "first_name": "Bench"}
+        return {"message_id": self._message_id, "date": int(time.time()), "chat": chat, **fields}
+
+    def _photo_message(self, chat_id):
+        message = self._message(chat_id)
+        file_id = f"uploaded{message['message_id']}"
+        message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]
+        return message
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if "/file/bot" in url:
+            # file download
+            return 200, self.image
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((time.perf_counter(), endpoint, params))
+        chat_id = params.get("chat_id", CHAT_ID)
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id, "file_path": f"photos/{file_id}.jpg"}
+        elif endpoint == "sendMediaGroup":
+            result = [self._photo_message(chat_id) for _ in params["media"]]
+        elif endpoint == "sendPhoto":
+            result = self._photo_message(chat_id)
+        elif endpoint in ("sendMessage", "editMessageText", "sendDocument"):
+            result = self._message(chat_id, text=params.get("text", ""))
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# update streams
+
+
+class Stream:
+    def __init__(self):
+        self.update_id = 0
+        self.texts = []
+        self.photos = []
+
+    def _update(self, **message):
+        self.update_id += 1
+        message.update(
+            message_id=self.update_id,
+            date=int(time.time()),
+            chat={"id": CHAT_ID, "type": "private", "first_name": "Bench"},
+            **{"from": USER},
+        )
+        return {"update_id": self.update_id, "message": message}
+
+    def text(self, length=80):
+        marker = f"msg-{self.update_id + 1:05d}"
+        self.texts.append(marker)
+        filler = " ".join(["Heute war ein langer Tag am See."] * (length // 32 + 1))
+        return self._update(text=f"{marker} {filler[:length]}")
+
+    def photo(self, media_group_id=None):
+        file_id = f"photo{self.update_id + 1:05d}"
+        self.photos.append(file_id + ".jpeg")
+        update = self._update(
+            photo=[{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}]
+        )
+        if media_group_id:
+            update["message"]["media_group_id"] = media_group_id
+        return update
+
+    def command(self, command):
+        return self._update(
+            text=command,
+            entities=[{"type": "bot_command", "offset": 0, "length": len(command.split()[0])}],
+        )
+
+
+def scenario(name, count):
+    stream = Stream()
+    if name == "voice":
+        # a long voice-to-text dump split into many messages
+        updates = [stream.text(length=3000) for _ in range(count)]
+    elif name == "album":
+        updates = [stream.photo(media_group_id="album1") for _ in range(10)]
+    elif name == "mixed":
+        updates = [stream.text() for _ in range(count // 2)]
+        updates.append(stream.command("/pdf"))
+        updates += [stream.text() for _ in range(count - count // 2)]
+        updates.append(stream.command("/pdf"))
+    else:
+        updates = [stream.text() for _ in range(count)]
+    return stream, updates
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# measurements
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else float("nan")
+
+
+class Timings:
+    def __init__(self):
+        self.handlers = {}
+        self.lag = []
+        self.last_done = None
+        # background jobs with their start and end time
+        self.jobs = []
+
+    def wrap(self, handler):
+        callback = handler.callback
+        name = getattr(callback, "__name__", type(handler).__name__)
+        if hasattr(handler, "commands"):
+            name = "/" + "/".join(sorted(handler.commands))
+
+        async def timed(update, context):
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                self.last_done = time.perf_counter()
+                self.handlers.setdefault(name, []).append(self.last_done - start)
+
+        handler.callback = timed
+
+    def track_jobs(self, manager):
+        """Record the jobs started through the job manager, e.g. by /pdf."""
+        start = manager.start
+
+        async def tracked(key, title, chat_id, bot, work):
+            began = time.perf_counter()
+            started = await start(key, title, chat_id, bot, work)
+            job = next((job for job in manager.running(chat_id) if job.key == key), None)
+            if started and job is not None:
+                timing = [job, began, None]
+                self.jobs.append(timing)
+                job.task.add_done_callback(lambda _: timing.__setitem__(2, time.perf_counter()))
+            return started
+
+        manager.start = tracked
+
+    def pending_jobs(self):
+        return [job for job, _, end in self.jobs if end is None]
+
+    async def watch_loop(self, interval=0.01):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.lag.append(time.perf_counter() - start - interval)
+
+
+async def replay(args):
+    """Replay the updates, print the report and return its numbers."""
+    import app
+    from diary import get_diary
+    from jobs import job_manager
+
+    data_dir = Path(tempfile.mkdtemp(prefix="diary-bench-"))
+    config = ConfigFactory.from_dict(
+        {
+            "api_key": "1:bench",
+            "chat_id": CHAT_ID,
+            "diary_csv": str(data_dir / "tagebuch.csv"),
+            "embedding_file": str(data_dir / "embeddings.npy"),
+            "image_dir": str(data_dir / "images"),
+            "data_dir": str(data_dir),
+            "mode": args.mode,
+            "warm_up": False,
+            "rate_limit": {"enabled": args.rate_limit},
+            "webhook": {"listen": "127.0.0.1", "port": free_port(), "secret_token": "bench"},
+        }
+    ).with_fallback(app.config)
+
+    FakeOpenAI.calls = {}
+    server = start_fake_openai(args.openai_latency)
+    request = RecordingRequest((ROOT / "data/images/image8.jpeg").read_bytes())
+    application = app.build_application(config, request=request)
+    timings = Timings()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            timings.wrap(handler)
+    timings.track_jobs(job_manager)
+
+    if args.updates:
+        stream = Stream()
+        updates = []
+        for path in args.updates:
+            data = json.loads(Path(path).read_text())
+            updates.extend(data if isinstance(data, list) else [data])
+        for update in updates:
+            update["message"]["chat"]["id"] = CHAT_ID
+            text = update["message"].get("text", "")
+            if text and not text.startswith("/"):
+                stream.texts.append(text)
+    else:
+        stream, updates = scenario(args.scenario, args.count)
+
+    await application.initialize()
+    await application.start()
+    webhook = None
+    if args.webhook:
+        webhook = app.webhook_server(application, config)
+        await webhook.serve_forever()
+        url = webhook_url(config)
+    watcher = asyncio.create_task(timings.watch_loop())
+    start = time.perf_counter()
+    posts = []
+    for data in updates:
+        if webhook:
+            posts.append(asyncio.create_task(asyncio.to_thread(post_update, url, data, "bench")))
+        else:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await asyncio.sleep(1 / args.rate)
+    statuses = [status for status, _ in await asyncio.gather(*posts)]
+    # wait until handlers and background jobs stopped producing calls
+    while True:
+        calls = len(request.calls)
+        await asyncio.sleep(args.settle)
+        if application.update_queue.empty() and len(request.calls) == calls and not timings.pending_jobs():
+            break
+    end = timings.last_done or time.perf_counter()
+    watcher.cancel()
+    del job_manager.start  # back to the method of the class
+    if webhook:
+        await webhook.shutdown()
+    await application.stop()
+    await application.shutdown()
+    server.shutdown()
+
+    diary = get_diary(config)
+    text = "\n".join(diary["entry"])
+    lost = [m for m in stream.texts if text.count(m) == 0]
+    duplicated = [m for m in stream.texts if text.count(m) > 1]
+    images = [image for images in diary["images"] for image in images]
+    lost_photos = [p for p in stream.photos if p not in images]
+    duplicated_photos = [p for p in stream.photos if images.count(p) > 1]
+
+    print(f"\nReplayed {len(updates)} updates at {args.rate}/s in {end - start:.2f} s "
+          f"({len(updates) / (end - start):.1f} updates/s)")
+    print(f"\n{'handler':<24}{'calls':>6}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, values in sorted(timings.handlers.items()):
+        print(f"{name:<24}{len(values):>6}{percentile(values, 50):>10.1f}{percentile(values, 99):>10.1f}")
+    # a handler that starts a job returns at once, the work shows up here
+    failed_jobs = []
+    if timings.jobs:
+        print(f"\n{'job':<32}{'outcome':>10}{'ms':>10}")
+        for job, began, finished in timings.jobs:
+            print(f"{job.title:<32}{job.outcome:>10}{(finished - began) * 1000:>10.1f}"
+                  + (f"  {job.error!r}" if job.error else ""))
+            if job.outcome != "done":
+                failed_jobs.append(job)
+    print(f"\nevent-loop lag: p50 {percentile(timings.lag, 50):.1f} ms, "
+          f"p99 {percentile(timings.lag, 99):.1f} ms, max {max(timings.lag, default=0) * 1000:.1f} ms")
+    endpoints = {}
+    for _, endpoint, _ in request.calls:
+        endpoints[endpoint] = endpoints.get(endpoint, 0) + 1
+    print(f"bot api calls: {endpoints}")
+    rejected = [status for status in statuses if status != 200]
+    if webhook:
+        print(f"webhook: {len(statuses) - len(rejected)}/{len(statuses)} updates accepted by {url}")
+    print(f"openai calls: {FakeOpenAI.calls}")
+    print(f"entries: {len(stream.texts) - len(lost)}/{len(stream.texts)} texts stored, "
+          f"{len(lost)} lost, {len(duplicated)} duplicated")
+    print(f"photos: {len(stream.photos) - len(lost_photos)}/{len(stream.photos)} stored, "
+          f"{len(lost_photos)} lost, {len(duplicated_photos)} duplicated")
+    print(f"data: {data_dir}")
+    return {
+        "lost": lost,
+        "duplicated": duplicated,
+        "lost_photos": lost_photos,
+        "duplicated_photos": duplicated_photos,
+        "rejected": rejected,
+        "failed_jobs": failed_jobs,
+        "jobs": len(timings.jobs),
+        "texts": len(stream.texts),
+        "photos": len(stream.photos),
+        "openai": dict(FakeOpenAI.calls),
+    }
+
+
+def passed(result):
+    return not any(result[name] for name in ["lost", "duplicated", "lost_photos", "duplicated_photos", "rejected", "failed_jobs"])
+
+
+# small scenarios with what they must produce, run with --check
+CHECKS = [
+    ("text burst", {"scenario": "text", "count": 20}),
+    ("photo album", {"scenario": "album", "count": 10}),
+    ("mixed with /pdf jobs", {"scenario": "mixed", "count": 20}),
+    ("recorded updates over the webhook", {"updates": ["bench/updates/text_burst.json"], "webhook": True}),
+]
+
+
+async def check(args):
+    """Run the CHECKS scenarios and assert on their results."""
+    for name, overrides in CHECKS:
+        print(f"\n== {name}")
+        result = await replay(argparse.Namespace(**{**vars(args), **overrides}))
+        assert result["texts"] + result["photos"] > 0, f"{name}: nothing to store"
+        for key in ["lost", "duplicated", "lost_photos", "duplicated_photos"]:
+            assert not result[key], f"{name}: {key} {result[key]}"
+        assert not result["rejected"], f"{name}: webhook rejected {result['rejected']}"
+        assert not result["failed_jobs"], f"{name}: failed jobs {[job.error for job in result['failed_jobs']]}"
+        if overrides.get("scenario") == "mixed":
+            assert result["jobs"] > 0, f"{name}: no /pdf job ran"
+        if result["texts"]:
+            # texts of a burst are embedded together, not one call per message
+            assert result["openai"].get("embeddings", 0) <= result["texts"], f"{name}: {result['openai']}"
+        print(f"ok: {name}")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", default="mixed", choices=["text", "voice", "album", "mixed"])
+    parser.add_argument("--updates", nargs="+", help="recorded update files instead of a scenario")
+    parser.add_argument("--count", type=int, default=50, help="messages in the scenario")
+    parser.add_argument("--rate", type=float, default=20, help="updates per second")
+    parser.add_argument("--mode", default="webhook", choices=["polling", "webhook"], help="update processing of this run mode")
+    parser.add_argument("--rate-limit", action="store_true", help="keep the telegram rate limiter")
+    parser.add_argument("--webhook", action="store_true", help="post the updates to the webhook server")
+    parser.add_argument("--openai-latency", type=float, default=0.2, help="seconds per fake openai call")
+    parser.add_argument("--settle", type=float, default=3.0, help="seconds without calls before stopping")
+    parser.add_argument("--check", action="store_true", help="run small scenarios and assert on their results")
+    args = parser.parse_args()
+    if args.check:
+        sys.exit(0 if asyncio.run(check(args)) else 1)
+    sys.exit(0 if passed(asyncio.run(replay(args))) else 1)
@@ -1,12 +1,21 @@
+import asyncio
+import importlib
 import logging
 from functools import partial
 from pathlib import Path
 
 import commands, os
-import openai
-from diary import *
+from diary import (
+    all_chat_configs,
+    for_chat,
+    notify_embedding_worker,
+    process_new_photo,
+    process_new_text,
+)
+from embed_queue import has_jobs
+from profiler import profiled
 from pyhocon import ConfigFactory
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -15,58 +24,178 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 config = ConfigFactory.parse_file(Path("config/config.conf"))
-api_key = config.get("api_key")
-openai.api_key = config.get("openai_key")
 # set env OPENAI_API_KEY to your openai key
 os.environ["OPENAI_API_KEY"] = config.get("openai_key")
 
+# names of the message handlers for /profile
+MESSAGE_HANDLERS = {"process_new_text": "text", "process_new_photo": "photo", "search": "date"}
+# modules only needed by some commands, they are imported on first use
+HEAVY_MODULES = ["openai", "openai_tools", "sklearn.metrics.pairwise", "pdf", "stats", "mood"]
 
-def main():
-    """Start the bot."""
-    dispatcher = Application.builder().token(api_key).build()
+
+async def warm_up():
+    """Imports the heavy modules in the background so the first command is fast."""
+    for name in HEAVY_MODULES:
+        try:
+            await asyncio.to_thread(importlib.import_module, name)
+        except ImportError as e:
+            logger.warning(f"Warm-up could not import {name}: {e}")
+    logger.info("Warm-up finished")
+
+
+async def post_init(application: Application, config):
+    commands.restore_schedules(application.job_queue, all_chat_configs(config))
+    # continue embedding entries that were queued before the restart
+    for chat in all_chat_configs(config):
+        if has_jobs(chat):
+            # the diary is backfilled when it is used, not on every restart
+            notify_embedding_worker(chat, backfill=False)
+    if config.get("warm_up", True):
+        application.create_task(warm_up())
+
+
+def build_application(config, request=None):
+    """Create the bot application with all handlers registered.
+
+    A custom telegram request object can be passed in, e.g. to run the
+    handlers against a stand-in for the bot api.
+    """
+    rate_limit = config.get("rate_limit", {})
+    builder = (
+        Application.builder()
+        .token(config.get("api_key"))
+        .post_init(partial(post_init, config=config))
+    )
+    if rate_limit.get("enabled", True):
+        # throttles all outgoing requests to telegram's overall and per-chat limits
+        builder = builder.rate_limiter(
+            AIORateLimiter(
+                overall_max_rate=rate_limit.get("overall_max_rate", 30),
+                group_max_rate=rate_limit.get("group_max_rate", 20),
+                max_retries=rate_limit.get("max_retries", 3),
+            )
+        )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    if config.get("mode", "polling") == "webhook":
+        # handle updates concurrently, writes are serialized per diary anyway
+        builder = builder.concurrent_updates(
+            config.get("webhook.concurrent_updates", 32)
+        )
+    dispatcher = builder.build()
 
     dispatcher.add_handler(
         MessageHandler(
-            filters.TEXT & ~filters.COMMAND, partial(process_new_text, config=config)
+            filters.TEXT & ~filters.COMMAND,
+            for_chat(process_new_text, config),
+            # let bursts reach the write queue together so they get coalesced
+            block=False,
         )
     )
     dispatcher.add_handler(
-        CommandHandler("daily", partial(commands.daily, config=config))
+        CommandHandler("daily", for_chat(commands.daily, config))
+    )
+    dispatcher.add_handler(
+        CommandHandler("monthly_report", for_chat(commands.monthly_report, config))
+    )
+    dispatcher.add_handler(
+        CommandHandler("onthisday", for_chat(commands.on_this_day, config))
+    )
+    dispatcher.add_handler(
+        CommandHandler("random", for_chat(commands.get_random_entry, config))
     )
     dispatcher.add_handler(
-        CommandHandler("monthly_report", partial(commands.monthly_report, config=config))
+        CommandHandler("get_data", for_chat(commands.get_data, config))
     )
     dispatcher.add_handler(
-        CommandHandler("random", partial(commands.get_random_entry, config=config))
+        CommandHandler("stats", for_chat(commands.get_stats, config))
     )
     dispatcher.add_handler(
-        CommandHandler("get_data", partial(commands.get_data, config=config))
+        CommandHandler("mood", for_chat(commands.mood, config))
     )
     dispatcher.add_handler(
-        CommandHandler("stats", partial(commands.get_stats, config=config))
+        CommandHandler("cancel", for_chat(commands.cancel, config))
     )
     dispatcher.add_handler(
-        CommandHandler("help", partial(commands.help, config=config))
+        CommandHandler("help", for_chat(commands.help, config))
     )
-    dispatcher.add_handler(CommandHandler("pdf", partial(commands.pdf, config=config)))
-    dispatcher.add_handler(CommandHandler("report", partial(commands.create_report_for_time, config=config)))
+    dispatcher.add_handler(CommandHandler("pdf", for_chat(commands.pdf, config)))
+    dispatcher.add_handler(CommandHandler("report", for_chat(commands.create_report_for_time, config)))
 
     dispatcher.add_handler(
-        CommandHandler("search", partial(commands.search_words, config=config))
+        CommandHandler("topics", for_chat(commands.topics, config))
+    )
+    dispatcher.add_handler(
+        CommandHandler("search", for_chat(commands.search_words, config))
     )
     dispatcher.add_handler(
         MessageHandler(
             filters.Regex(r"/(\d{1,2}_\d{1,2}_\d{2,4})(s_\d)?"),
-            partial(commands.search, config=config),
+            for_chat(commands.search, config),
         )
     )
     dispatcher.add_handler(
-        MessageHandler(filters.PHOTO, partial(process_new_photo, config=config))
+        MessageHandler(
+            filters.PHOTO, for_chat(process_new_photo, config), block=False
+        )
     )
-    logger.info("Bot started")
-    dispatcher.run_polling(
-        read_timeout=15, timeout=20, connect_timeout=15, write_timeout=15
+    dispatcher.add_handler(
+        CommandHandler("profile", partial(commands.profile, config=config))
     )
+    # every handler can be armed with /profile, commands by their name
+    for handler in dispatcher.handlers[0]:
+        if isinstance(handler, CommandHandler):
+            name = sorted(handler.commands)[0]
+        else:
+            name = MESSAGE_HANDLERS[handler.callback.__name__]
+        handler.callback = profiled(name, handler.callback)
+    return dispatcher
+
+
+def webhook_server(application, config):
+    """The webhook server of run_webhook, without registering the webhook at telegram.
+
+    Serves updates posted to the local address, so webhook mode can be tested
+    without a public url, e.g. with bench/replay.py --webhook. Call
+    serve_forever() after application.start() and shutdown() before stop().
+    """
+    from telegram.ext._utils.webhookhandler import WebhookAppClass, WebhookServer
+
+    webhook = config.get("webhook")
+    app = WebhookAppClass(
+        "/" + webhook.get("path", "telegram").strip("/"),
+        application.bot,
+        application.update_queue,
+        webhook.get("secret_token", None) or None,
+    )
+    return WebhookServer(webhook.get("listen", "0.0.0.0"), webhook.get("port", 8443), app, None)
+
+
+def main():
+    """Start the bot."""
+    mode = config.get("mode", "polling")
+    if mode == "webhook" and not config.get("webhook.url", ""):
+        # telegram only posts to a public https url, it rejects the local address
+        raise ValueError(
+            "mode = webhook needs webhook.url, the public https url telegram posts updates to"
+        )
+    dispatcher = build_application(config)
+    logger.info(f"Bot started in {mode} mode")
+    if mode == "webhook":
+        webhook = config.get("webhook")
+        path = webhook.get("path", "telegram").strip("/")
+        dispatcher.run_webhook(
+            listen=webhook.get("listen", "0.0.0.0"),
+            port=webhook.get("port", 8443),
+            url_path=path,
+            webhook_url=webhook.get("url"),
+            secret_token=webhook.get("secret_token", None) or None,
+            max_connections=webhook.get("max_connections", 40),
+        )
+    else:
+        dispatcher.run_polling(
+            read_timeout=15, timeout=20, connect_timeout=15, write_timeout=15
+        )
 
 
 if __name__ == "__main__":
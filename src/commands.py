@@ -1,21 +1,22 @@
 import logging
-import random
-import shutil
-from datetime import datetime, time
+import zipfile
+from datetime import datetime, time, timedelta
 from functools import partial
 from pathlib import Path
 
+import numpy as np
 import pytz
 import telegram
-import fpdf
-from diary import correct_chat, get_diary, get_month_data, get_report
-from openai_tools import get_similar_entries, search_entries
-from pdf import create_pdf
-from search import get_entry_by_date, search_by_date, send_day_before_and_after
-from stats import make_stats
+from diary import correct_chat, get_diary, get_report
+from neighbours import entry_keys, get_neighbours, related_keys
+from digest import get_digest, prepare_digest, send_digest
+from jobs import add_schedule, job_manager, load_schedules
+from profiler import arm, profilable, profiled, to_thread
+from search import search_by_date, send_day_before_and_after
+from sender import send_photos
+from topics import describe_topics, load_topics
 from telegram import Update
 from telegram.ext import CallbackContext
-from prompt_template import get_prompt
 
 
 logging.basicConfig(
@@ -33,14 +34,18 @@ async def help(update: Update, context: CallbackContext, config) -> None:
         \n\nHere are the commands I understand:
         \n`/daily` - I will send you every day a diary entry created on this day in the past at 8:30.
         \n `/monthly_report` - I will send you a monthly report of your diary
+        \n`/onthisday` - I will send you what you wrote on this day in the past years
         \n`/random` - I will send you a random entry from your diary
         \n`/get_data` - I will send you your diary as a csv file and your images zipped
         \n`/stats` - I will send you a plot of your entries per day
+        \n`/mood -s 19.01.2012 -e 22.12.2022` - I will send you a chart of your mood over time
         \n`/pdf -s 19.01.2012 -e 22.12.2022` - I will send you a pdf of your diary
         \n`/2_2_2020` - I will send you the entry for the given date
         \n`/2_2_2020s_2` - I will send you the entry for the given date and two similar entries
-        \n`/search I am happy -n 2` - I will send you the the most similar entries containing the given query
+        \n`/search I am happy -n 2` - I will send you the passages of the most similar entries with the best match in bold
+        \n`/topics` - I will send you the recurring topics of your diary
         \n`/report -s 19.01.2012 -e 22.12.2022` - I will send you a analysis of your diary for the given time period
+        \n`/cancel` - I will stop the pdf, report or data export that is running
         \n`/help` - I will send you this message
         """
         await context.bot.send_message(
@@ -49,18 +54,63 @@ async def help(update: Update, context: CallbackContext, config) -> None:
         await delete_message(context, update.message.chat_id, update.message.message_id)
 
 
+def schedule_daily(job_queue, config) -> bool:
+    """Registers the daily jobs of a chat, returns False if they already exist."""
+    chat_id = int(config.get("chat_id"))
+    if job_queue.get_jobs_by_name(f"daily_{chat_id}"):
+        return False
+    job_queue.run_daily(
+        profiled("daily_job", partial(daily_job, config=config)),
+        time(hour=8, minute=30, tzinfo=pytz.timezone("Europe/Amsterdam")),
+        chat_id=chat_id,
+        name=f"daily_{chat_id}",
+    )
+    job_queue.run_daily(
+        profiled("prepare_digest_job", partial(prepare_digest_job, config=config)),
+        time(hour=23, minute=0, tzinfo=pytz.timezone("Europe/Amsterdam")),
+        chat_id=chat_id,
+        name=f"digest_{chat_id}",
+    )
+    return True
+
+
+def schedule_monthly_report(job_queue, config) -> bool:
+    """Registers the monthly report of a chat, returns False if it already exists."""
+    chat_id = int(config.get("chat_id"))
+    if job_queue.get_jobs_by_name(f"monthly_report_{chat_id}"):
+        return False
+    job_queue.run_monthly(
+        callback=profiled("monthly_report_job", partial(monthly_report_job, config=config)),
+        when=time(hour=8, minute=15, tzinfo=pytz.timezone("Europe/Amsterdam")),
+        day=1,
+        chat_id=chat_id,
+        name=f"monthly_report_{chat_id}",
+    )
+    return True
+
+
+SCHEDULES = {"daily": schedule_daily, "monthly_report": schedule_monthly_report}
+
+
+def restore_schedules(job_queue, configs):
+    """Registers the jobs that were set before the last restart."""
+    for config in configs:
+        for name in load_schedules(config):
+            if SCHEDULES[name](job_queue, config):
+                logger.info(f"Restored {name} job for {config.get('chat_id')}")
+
+
 async def daily(update: Update, context: CallbackContext, config) -> None:
     """Sets a daily job to send a entry for the current day at 8:30."""
     chat_id = update.message.chat_id
     if correct_chat(chat_id, config):
         logger.info("Set daily job")
-        context.job_queue.run_daily(
-            partial(daily_job, config=config),
-            time(hour=8, minute=30, tzinfo=pytz.timezone("Europe/Amsterdam")),
-            chat_id=chat_id,
-            name=str(chat_id),
-        )
-        await context.bot.send_message(chat_id=chat_id, text="Daily memory set!")
+        add_schedule(config, "daily")
+        if schedule_daily(context.job_queue, config):
+            text = "Daily memory set!"
+        else:
+            text = "Daily memory is already set."
+        await context.bot.send_message(chat_id=chat_id, text=text)
         await delete_message(context, update.message.chat_id, update.message.message_id)
 
 async def monthly_report(update: Update, context: CallbackContext, config) -> None:
@@ -68,14 +118,12 @@ async def monthly_report(update: Update, context: CallbackContext, config) -> No
     chat_id = update.message.chat_id
     if correct_chat(chat_id, config):
         logger.info("Set monthly report")
-        context.job_queue.run_monthly(
-            callback=partial(monthly_report_job, config=config),
-            when=time(hour=8, minute=15, tzinfo=pytz.timezone("Europe/Amsterdam")),
-            day=1, 
-            chat_id=chat_id,
-            name=str(chat_id),
-        )
-        await context.bot.send_message(chat_id=chat_id, text="Monthly report set!")
+        add_schedule(config, "monthly_report")
+        if schedule_monthly_report(context.job_queue, config):
+            text = "Monthly report set!"
+        else:
+            text = "Monthly report is already set."
+        await context.bot.send_message(chat_id=chat_id, text=text)
         await delete_message(context, update.message.chat_id, update.message.message_id)
 
 async def get_data(update: Update, context: CallbackContext, config) -> None:
@@ -83,42 +131,62 @@ async def get_data(update: Update, context: CallbackContext, config) -> None:
     chat_id = update.message.chat_id
     if correct_chat(chat_id, config):
         logger.info("get_data")
-        # zip data send
-        current_date = datetime.now().date()
-        zip = shutil.make_archive(
-            config.get("data_dir") + f"_{current_date}", "zip", config.get("data_dir")
-        )
-        await context.bot.send_document(chat_id=chat_id, document=open(zip, "rb"))
+
+        async def work(job):
+            # zip data send
+            job.progress("zipping data")
+            zip = await to_thread(zip_data, config)
+            job.progress("uploading")
+            with open(zip, "rb") as f:
+                await context.bot.send_document(chat_id=chat_id, document=f)
+
+        await job_manager.start(f"{chat_id}:get_data", "Data export", chat_id, context.bot, work)
         await delete_message(context, update.message.chat_id, update.message.message_id)
 
 
+def zip_data(config):
+    """Zips the data of a diary, the diaries of other chats are left out."""
+    data_dir = Path(config.get("data_dir")).resolve()
+    diaries_dir = Path(config.get("diaries_dir", "data/diaries")).resolve()
+    archive = f"{config.get('data_dir')}_{datetime.now().date()}.zip"
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as f:
+        for path in sorted(data_dir.rglob("*")):
+            if path.is_file() and diaries_dir != path and diaries_dir not in path.parents:
+                f.write(path, path.relative_to(data_dir))
+    return archive
+
+
 async def daily_job(context: CallbackContext, config) -> None:
     today = datetime.now().date()
-    diary_today = get_entry_by_date(today, config)
-    if len(diary_today) > 0:
+    digest = await to_thread(get_digest, today, config)
+    if await send_digest(digest, context.bot, context.job.chat_id, config):
         logger.info("Run daily job...")
-        if len(diary_today) == 1:
-            entry = diary_today
-        else:
-            # if there are multiple entries for today choose one
-            entry = diary_today.sample()
-        text = entry["entry"].values[0]
-        pretext = f"There are {len(diary_today)} entries for today. \nHere is what you wrote in {entry['date'].dt.date.values[0]}:\n\n"
-        text = pretext + text
-        images = entry["images"].values[0]
-        await send_message(text, context, config, job=True)
-        if len(images) > 0:
-            # choose one image
-            image = random.choice(images)
-            with open(Path(config.get("image_dir")) / Path(image), "rb") as f:
-                await context.bot.send_photo(context.job.chat_id, photo=f)
-        await send_day_before_and_after(entry, context, config)
     else:
         logger.info("No entry for today")
         await context.bot.send_message(
             context.job.chat_id, text="No entry for today, you should write one!"
         )
 
+
+async def prepare_digest_job(context: CallbackContext, config) -> None:
+    """Prepares the digest of the next day, so the daily job only has to send it."""
+    tomorrow = datetime.now().date() + timedelta(days=1)
+    await to_thread(prepare_digest, tomorrow, config)
+
+
+async def on_this_day(update: Update, context: CallbackContext, config) -> None:
+    """Sends what was written on this day in the past years."""
+    chat_id = update.message.chat_id
+    if correct_chat(chat_id, config):
+        logger.info("on_this_day")
+        today = datetime.now().date()
+        digest = await to_thread(get_digest, today, config)
+        if not await send_digest(digest, context.bot, chat_id, config):
+            await context.bot.send_message(
+                chat_id=chat_id, text="Nothing was written on this day in the past years."
+            )
+        await delete_message(context, update.message.chat_id, update.message.message_id)
+
 async def monthly_report_job(context: CallbackContext, config) -> None:
     today = datetime.now().date()
     year = today.year
@@ -129,8 +197,10 @@ async def monthly_report_job(context: CallbackContext, config) -> None:
         month = 12
         year = year - 1
         
-    diary = get_diary(config)
-    month_data = get_month_data(diary, month, year)
+    # only the partition of the month is read
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1) - timedelta(microseconds=1)
+    month_data = get_diary(config, start, end)
     
     report = get_report(month_data, config)
     
@@ -147,7 +217,6 @@ async def create_report_for_time(update: Update, context: CallbackContext, confi
     chat_id = update.message.chat_id
     if correct_chat(chat_id, config):
         logger.info("create report...")
-        data = get_diary(config)
         # read parameters from message -s for start_date and -e for end_date
         args = context.args
         start_date = None
@@ -158,18 +227,95 @@ async def create_report_for_time(update: Update, context: CallbackContext, confi
             end_date = args[args.index("-e") + 1]
             
         logger.info(f"start_date: {start_date}, end_date: {end_date}")
+
+        async def work(job):
+            job.progress("loading diary")
+            # convert to datetime: str:22.02.2020, only the months in the range are read
+            start = datetime.strptime(start_date, "%d.%m.%Y") if start_date else None
+            end = datetime.strptime(end_date, "%d.%m.%Y") if end_date else None
+            data = await to_thread(get_diary, config, start, end)
+            job.progress(f"writing report for {len(data)} entries")
+            report = await to_thread(get_report, data, config)
+            await send_message(report, context, config)
+
+        key = f"{chat_id}:report:{start_date}:{end_date}"
+        await job_manager.start(key, "Report", chat_id, context.bot, work)
+        await delete_message(context, update.message.chat_id, update.message.message_id)
+
+async def topics(update: Update, context: CallbackContext, config):
+    """Sends the recurring topics of the diary."""
+    chat_id = update.message.chat_id
+    if correct_chat(chat_id, config):
+        logger.info("topics")
+        model = load_topics(config)
+        if model is None:
+            await context.bot.send_message(
+                chat_id=chat_id, text="There are not enough entries for topics yet."
+            )
+        else:
+            text = describe_topics(model, get_diary(config))
+            await send_message(text, context, config)
+        await delete_message(context, update.message.chat_id, update.message.message_id)
+
+
+async def mood(update: Update, context: CallbackContext, config):
+    """Sends a chart of the mood of the entries over time."""
+    chat_id = update.message.chat_id
+    if correct_chat(chat_id, config):
+        logger.info("mood")
+        from mood import get_mood
+        from stats import make_mood_chart
+
+        # read parameters from message -s for start_date and -e for end_date
+        args = context.args
+        start_date = None
+        end_date = None
+        if "-s" in args:
+            start_date = args[args.index("-s") + 1]
+        if "-e" in args:
+            end_date = args[args.index("-e") + 1]
+
+        # the whole diary is scored, so the cache only holds current entries
+        data = await to_thread(get_mood, get_diary(config), config)
         if start_date:
-            # convert to datetime: str:22.02.2020
-            start_date = datetime.strptime(start_date, "%d.%m.%Y")
-            data = data[(data["date"] >= start_date)]
+            data = data[(data["date"] >= datetime.strptime(start_date, "%d.%m.%Y"))]
         if end_date:
-            end_date = datetime.strptime(end_date, "%d.%m.%Y")
-            data = data[(data["date"] <= end_date)]
-            
-        report = get_report(data, config)
-        await send_message(report, context, config)
+            data = data[(data["date"] <= datetime.strptime(end_date, "%d.%m.%Y"))]
+        if data["mood"].notna().sum() == 0:
+            await context.bot.send_message(
+                chat_id=chat_id, text="There are no entries with a mood in this time."
+            )
+        else:
+            text, mood_chart = await to_thread(
+                make_mood_chart, data, config.get("mood.window", "30D")
+            )
+            await context.bot.send_message(chat_id=chat_id, text=text)
+            with open(mood_chart, "rb") as f:
+                await context.bot.send_photo(chat_id=chat_id, photo=f)
+        await delete_message(context, update.message.chat_id, update.message.message_id)
+
+
+async def profile(update: Update, context: CallbackContext, config):
+    """Profiles the next run of a command or job, only for the main chat."""
+    chat_id = update.message.chat_id
+    if correct_chat(chat_id, config):
+        # /profile pdf -n 40 -m, -n rows of the table, -m also traces allocations
+        args = context.args
+        name = args[0].lstrip("/") if args else None
+        if name not in profilable:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="Usage: /profile <name> [-n rows] [-m]\n\nNames: " + ", ".join(sorted(profilable)),
+            )
+        else:
+            top = int(args[args.index("-n") + 1]) if "-n" in args else 30
+            arm(name, chat_id, top=top, memory="-m" in args)
+            await context.bot.send_message(
+                chat_id=chat_id, text=f"The next run of {name} will be profiled."
+            )
         await delete_message(context, update.message.chat_id, update.message.message_id)
 
+
 async def delete_message(context: CallbackContext, chat_id, message_id):
     """Deletes the message that triggered the command."""
     await context.bot.delete_message(
@@ -192,9 +338,7 @@ async def get_random_entry(update: Update, context: CallbackContext, config):
         await send_message(text, context, config)
         images = random_entry["images"].values[0]
         if len(images) > 0:
-            for image in images:
-                with open(Path(config.get("image_dir")) / Path(image), "rb") as f:
-                    await context.bot.send_photo(chat_id=chat_id, photo=f)
+            await send_photos(context.bot, chat_id, images, config)
         await delete_message(context, update.message.chat_id, update.message.message_id)
         await send_day_before_and_after(random_entry, context, config)
 
@@ -204,6 +348,8 @@ async def get_stats(update: Update, context: CallbackContext, config):
     chat_id = update.message.chat_id
     if correct_chat(chat_id, config):
         logger.info("get_stats")
+        from stats import make_stats
+
         diary = get_diary(config)
         stats, entries_per_weekday, entries_per_month = make_stats(diary)
 
@@ -233,7 +379,6 @@ async def pdf(update: Update, context: CallbackContext, config):
     chat_id = update.message.chat_id
     if correct_chat(chat_id, config):
         logger.info("create pdf...")
-        diary = get_diary(config)
         # read parameters from message -s for start_date and -e for end_date
         args = context.args
         start_date = None
@@ -242,19 +387,60 @@ async def pdf(update: Update, context: CallbackContext, config):
             start_date = args[args.index("-s") + 1]
         if "-e" in args:
             end_date = args[args.index("-e") + 1]
-        try:
-            pdf_path = create_pdf(diary, config["author"], start_date, end_date, table_of_contents_pages=5)
-        except fpdf.errors.FPDFException as e:
-            logger.error(e)
-            # extract toc number of pages from error message
-            if "ended on page" in str(e):
-                toc_pages = int(str(e).split("ended on page ")[1].split(" ")[0]) - 1
-                logger.info(f"TOC has {toc_pages} pages")
-                pdf_path = create_pdf(diary, config["author"], start_date, end_date, table_of_contents_pages=toc_pages)
-            else:
-                raise e
-            
-        await context.bot.send_document(chat_id=chat_id, document=open(pdf_path, "rb"))
+
+        async def work(job):
+            job.progress("loading diary")
+            pdf_path = await to_thread(
+                render_pdf, config, start_date, end_date, job.progress
+            )
+            if pdf_path is None:
+                await context.bot.send_message(
+                    chat_id=chat_id, text="There are no entries in this time range."
+                )
+                return
+            job.progress("uploading")
+            with open(pdf_path, "rb") as f:
+                await context.bot.send_document(chat_id=chat_id, document=f)
+
+        key = f"{chat_id}:pdf:{start_date}:{end_date}"
+        await job_manager.start(key, "PDF", chat_id, context.bot, work)
+        await delete_message(context, update.message.chat_id, update.message.message_id)
+
+
+def render_pdf(config, start_date=None, end_date=None, progress=None):
+    """Creates the pdf of the diary, retries with the right number of toc pages.
+
+    Returns None if there are no entries in the time range.
+    """
+    import fpdf
+    from pdf import create_pdf
+
+    # only the months in the range are read, create_pdf filters the days
+    start = datetime.strptime(start_date, "%d.%m.%Y") if start_date else None
+    end = datetime.strptime(end_date, "%d.%m.%Y") if end_date else None
+    diary = get_diary(config, start, end)
+    if len(diary) == 0:
+        return None
+    related = related_keys(config)
+    try:
+        return create_pdf(diary, config["author"], start_date, end_date, table_of_contents_pages=5, image_dir=config.get("image_dir"), related=related, progress=progress)
+    except fpdf.errors.FPDFException as e:
+        logger.error(e)
+        # extract toc number of pages from error message
+        if "ended on page" in str(e):
+            toc_pages = int(str(e).split("ended on page ")[1].split(" ")[0]) - 1
+            logger.info(f"TOC has {toc_pages} pages")
+            return create_pdf(diary, config["author"], start_date, end_date, table_of_contents_pages=toc_pages, image_dir=config.get("image_dir"), related=related, progress=progress)
+        raise e
+
+
+async def cancel(update: Update, context: CallbackContext, config):
+    """Cancels the running background jobs of the chat."""
+    chat_id = update.message.chat_id
+    if correct_chat(chat_id, config):
+        cancelled = job_manager.cancel(chat_id)
+        text = f"Cancelled {cancelled} job(s)." if cancelled else "Nothing is running."
+        await context.bot.send_message(chat_id=chat_id, text=text)
         await delete_message(context, update.message.chat_id, update.message.message_id)
 
 
@@ -263,6 +449,8 @@ async def search(update: Update, context: CallbackContext, config):
     chat_id = update.message.chat_id
     if correct_chat(chat_id, config):
         logger.info("search...")
+        from openai_tools import get_similar_entries
+
         date = update.message.text
         date = date.replace("_", ".").replace("/", "")
         diary = get_diary(config)
@@ -274,9 +462,16 @@ async def search(update: Update, context: CallbackContext, config):
                 date, diary, update, context, config, send=False
             )
             if len(entry) > 0 and similar:
-                similar_entries = get_similar_entries(
-                    diary, entry["embedding"].values[0], int(similar)
-                )
+                key = entry_keys(diary["date"])[diary.index.get_loc(entry.index[0])]
+                similar_entries = get_neighbours(diary, key, int(similar), config)
+                if similar_entries is None:
+                    embedding = entry["embedding"].values[0] if "embedding" in entry.columns else None
+                    if not isinstance(embedding, np.ndarray):
+                        await update.message.reply_text(
+                            text="This entry is not indexed yet, try again in a moment."
+                        )
+                        return
+                    similar_entries = get_similar_entries(diary, embedding, int(similar))
                 for i, similar_entry in similar_entries.iterrows():
                     text = f"Here is a similar entry from {similar_entry['date'].date().strftime('%d.%m.%Y')}:\n\n"
                     await send_message(
@@ -310,9 +505,12 @@ async def send_message(
 
 
 async def search_words(update: Update, context: CallbackContext, config):
-    """Creates a pdf from the diary and sends it to the user."""
+    """Sends the passages that match the given query best."""
     chat_id = update.message.chat_id
     if correct_chat(chat_id, config):
+        from openai_tools import get_embedding
+        from passages import format_passage, search_passages
+
         diary = get_diary(config)
         # read parameters from message -s for start_date and -e for end_date
         args = context.args
@@ -322,19 +520,44 @@ async def search_words(update: Update, context: CallbackContext, config):
         else:
             n = 1
             search_query = " ".join(args)
-        similar_entries = search_entries(diary, search_query, n)
+        query_embedding = await to_thread(get_embedding, search_query)
+        results = await to_thread(search_passages, config, query_embedding, n)
+        if results is None:
+            # no passage index yet, fall back to whole entries
+            await send_similar_entries(diary, query_embedding, n, context, config)
+        positions = {key: i for i, key in enumerate(entry_keys(diary["date"]))}
+        for key, start, end, similarity in results or []:
+            if key not in positions:
+                continue
+            entry = diary.iloc[positions[key]]
+            if end > len(entry["entry"]):
+                continue
+            date = entry["date"].date()
+            text = (
+                f"From {date.strftime('%d.%m.%Y')} with similarity {round(similarity, 3)}:\n\n"
+                + format_passage(entry["entry"], start, end, search_query)
+                + f"\n\nWhole entry: /{date.strftime('%d_%m_%Y')}"
+            )
+            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML")
+            if len(entry["images"]) > 0:
+                await send_photos(context.bot, chat_id, entry["images"], config)
+            await send_day_before_and_after(entry, context, config)
+
+        await delete_message(context, update.message.chat_id, update.message.message_id)
 
-        for entry in similar_entries.iterrows():
-            logger.info(entry)
-            text = f"Here is a similar entry from {entry[1]['date'].date().strftime('%d.%m.%Y')} with similarity {round(entry[1]['similarity'][0][0], 3)}:\n\n"
-            text = text + str(entry[1]["entry"])
 
-            await send_message(text, context, config)
-            images = entry[1]["images"]
-            if len(images) > 0:
-                for image in images:
-                    with open(Path(config.get("image_dir")) / Path(image), "rb") as f:
-                        await context.bot.send_photo(chat_id=chat_id, photo=f)
-            await send_day_before_and_after(entry[1], context, config)
+async def send_similar_entries(diary, embedding, n, context: CallbackContext, config):
+    """Sends the whole entries most similar to an embedding."""
+    from openai_tools import get_similar_entries
 
-        await delete_message(context, update.message.chat_id, update.message.message_id)
+    similar_entries = get_similar_entries(diary, embedding, n)
+    for entry in similar_entries.iterrows():
+        logger.info(entry)
+        text = f"Here is a similar entry from {entry[1]['date'].date().strftime('%d.%m.%Y')} with similarity {round(entry[1]['similarity'][0][0], 3)}:\n\n"
+        text = text + str(entry[1]["entry"])
+
+        await send_message(text, context, config)
+        images = entry[1]["images"]
+        if len(images) > 0:
+            await send_photos(context.bot, context._chat_id, images, config)
+        await send_day_before_and_after(entry[1], context, config)
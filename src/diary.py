@@ -1,17 +1,21 @@
-import ast
 import logging
-import os
 from datetime import datetime, timedelta
+from functools import partial, wraps
 from pathlib import Path
 
-import numpy as np
 import pandas as pd
 from telegram import Update
 from telegram.ext import CallbackContext
 from prompt_template import get_prompt
-from openai import OpenAI
+from pyhocon import ConfigFactory
 
-from openai_tools import add_embedding, get_embedding
+from embed_queue import enqueue, get_embedding_worker
+from neighbours import entry_keys, update_neighbours
+from passages import passages_path, update_passage_index
+from store import get_store
+from summarize import estimate_tokens, summarize_entries
+from topics import update_topics
+from write_queue import get_write_queue
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -34,41 +38,33 @@ def create_diary_entry(text, insert_time=True):
     logger.info(f"New diary entry created: {df}")
     return df
 
-def get_month_data(data, month, year):
-    month_data = data[(data['date'].dt.month == month) & (data['date'].dt.year == year)]
-    return month_data
-
-def get_diary(config):
-    """Get the diary of the user."""
-    # get the diary of the user
-    df = pd.read_csv(config.get("diary_csv"))
-    df["images"] = df["images"].apply(ast.literal_eval)
-    df["date"] = pd.to_datetime(df["date"])
-    df["entry"] = df["entry"].astype(str)
-    # check if embedding file exists
-    if Path(config.get("embedding_file")).exists():
-        embeddings = np.load(config.get("embedding_file"), allow_pickle=True)
-        embeddings = np.array(embeddings.tolist())
-        df["embedding"] = embeddings.tolist()
+def get_diary(config, start=None, end=None):
+    """Get the diary of the user, only the entries from start to end if given."""
+    return get_store(config).get(config, start, end)
 
-    return df
 
+def save_diary(df, config, months=None):
+    """Save the diary, only the given months ("2022-12") if the others did not change."""
+    get_store(config).save(df, config, months)
 
-def save_diary(df, config):
-    # save embedding to numpy
-    embedding = np.array(df["embedding"].values)
-    np.save(config.get("embedding_file"), embedding)
-    # remove embedding column
-    df = df.drop(columns=["embedding"])
-    df.to_csv(config.get("diary_csv"), index=False)
 
 def get_report(data, config):
+    data = data.copy()
+    budget = config.get("report.token_budget", 6000)
+    if config.get("report.summarize", False) and estimate_tokens("".join(data["entry"])) > budget:
+        # keep only the most central sentences so the prompt stays within the budget
+        data = summarize_entries(data, budget)
     # create summary
     data.loc[:, 'entry'] = data.apply(lambda x: f"{x['date'].strftime('%d/%m/%Y')}\n{x['entry']}", axis=1)
     entries = "\n\n".join(data['entry'].values)
     name = config['author'].split(" ")[0]
     prompt = get_prompt().format(name=name)
     entries = "\n\n##### Tagebucheinträge #####\n\n" + entries + "\n\n##### Ende der Tagebucheinträge #####\n\n"
+    logger.info(
+        f"Report for {len(data)} entries, about {estimate_tokens(prompt + entries)} prompt tokens"
+    )
+    from openai import OpenAI
+
     client = OpenAI(api_key=config['openai_key'])
     response = client.chat.completions.create(
     model="gpt-4",
@@ -80,24 +76,14 @@ def get_report(data, config):
     res = response.choices[0].message.content
     return res
     
-async def process_new_text(update: Update, context: CallbackContext, config):
-    """Process the new text from the user."""
-    # process the new text from the user
-    # create a new diary entry
-    chat_id = update.message.chat_id
-    text = str(update.message.text)
-    if correct_chat(chat_id, config) and len(text) > 0:
-        logger.info(f"New text received: {text}")
+def merge_update(diary_today, update):
+    """Merge one new text or photo into the entries of today."""
+    text = update.get("text")
+    image = update.get("image")
+    if text is not None:
         df = create_diary_entry(text)
-        # get the diary
-        diary = get_diary(config)
-        # check if there is already an entry for today
-        today = datetime.now().date()
-        diary_today = diary[diary["date"].dt.date == today]
-        diary = diary[diary["date"].dt.date != today]
         if len(diary_today) > 0:
             # if there is already an entry for today, append the new text to the existing entry
-            # strftime() is used to convert the datetime object to a string
             logger.info(f"Entry for today already exists: {diary_today}")
             # check if last entry is older than 5 minutes
             last_date = diary_today["date"].values[-1]
@@ -112,11 +98,103 @@ async def process_new_text(update: Update, context: CallbackContext, config):
             ]
             diary_today["date"] = df["date"].values[0]
             df = diary_today
-        df = add_embedding(df)
+        return df
+    if len(diary_today) > 0:
+        # if there is already an entry for today, append the new photo to the existing entry
+        logger.info(f"Entry for today already exists: {diary_today}")
+        diary_today["images"] = [diary_today["images"].values[0] + [image]]
+        return diary_today
+    # if there is no entry for today, create a new entry
+    logger.info("No entry for today exists")
+    df = create_diary_entry("")
+    df["images"] = [[image]]
+    return df
+
+
+def apply_updates(updates, config):
+    """Apply a batch of new texts, photos and embeddings with one save.
+
+    Entries changed by texts or photos are saved right away and queued for
+    embedding, embeddings are only stored if the entry has not changed since.
+    """
+    diary = get_diary(config)
+    messages = [update for update in updates if "embeddings" not in update]
+    changed = []
+    if messages:
+        # check if there is already an entry for today
+        today = datetime.now().date()
+        diary_today = diary[diary["date"].dt.date == today].copy()
+        diary = diary[diary["date"].dt.date != today]
+        for update in messages:
+            diary_today = merge_update(diary_today, update)
         # append the new entry to the diary
-        diary = pd.concat([diary, df])
-        # save the diary
-        save_diary(diary, config)
+        diary = pd.concat([diary, diary_today]).reset_index(drop=True)
+        changed = entry_keys(diary["date"])[-len(diary_today):]
+    embedded = []
+    passages = {}
+    keys = entry_keys(diary["date"])
+    embeddings = list(diary["embedding"]) if "embedding" in diary.columns else [None] * len(diary)
+    for update in updates:
+        for key, (text, embedding) in update.get("embeddings", {}).items():
+            if key not in keys:
+                continue
+            position = keys.index(key)
+            current = diary["entry"].values[position]
+            if key not in changed and current == text and embedding is not None:
+                embeddings[position] = embedding
+                embedded.append(key)
+            # passages stay valid while the entry only grew behind them
+            if key in update.get("passages", {}):
+                passages[key] = [
+                    p for p in update["passages"][key] if current[p[0] : p[1]] == text[p[0] : p[1]]
+                ]
+    diary["embedding"] = embeddings
+    # save the diary, only the months of changed entries are written
+    save_diary(diary, config, months={key[:7] for key in changed + embedded})
+    if changed:
+        enqueue(config, changed)
+    if embedded or passages:
+        update_indexes(diary, config, embedded, passages)
+
+
+def update_indexes(diary, config, changed, passages=None):
+    """Update the neighbour graph, the topics and the passages of entries with a new embedding."""
+    for update in (update_neighbours, update_topics) if changed else ():
+        try:
+            update(diary, config, changed)
+        except Exception as e:
+            # the entry is saved anyway, the index catches up on the next write
+            logger.error(f"{update.__name__} failed: {e}")
+    if passages and (any(passages.values()) or passages_path(config).exists()):
+        # entries without text, e.g. only photos, have no passages
+        try:
+            update_passage_index(config, passages)
+        except Exception as e:
+            logger.error(f"update_passage_index failed: {e}")
+
+
+def submit_update(update, config):
+    """Queue an update for the diary, returns once it has been saved."""
+    queue = get_write_queue(
+        config.get("diary_csv"),
+        partial(apply_updates, config=config),
+        window=config.get("write_window", 1.0),
+    )
+    return queue.submit(update)
+
+
+def notify_embedding_worker(config, backfill=True):
+    get_embedding_worker(config, partial(submit_update, config=config)).notify(backfill)
+
+
+async def process_new_text(update: Update, context: CallbackContext, config):
+    """Process the new text from the user."""
+    chat_id = update.message.chat_id
+    text = str(update.message.text)
+    if correct_chat(chat_id, config) and len(text) > 0:
+        logger.info(f"New text received: {text}")
+        await submit_update({"text": text}, config)
+        notify_embedding_worker(config)
         await context.bot.send_message(
             chat_id=chat_id, text="Your entry has been saved."
         )
@@ -125,36 +203,15 @@ async def process_new_text(update: Update, context: CallbackContext, config):
 async def process_new_photo(update: Update, context: CallbackContext, config):
 
     if correct_chat(update.message.chat_id, config=config):
-        # process the new photo from the user
-        # get the diary
-        diary = get_diary(config)
-        # check if there is already an entry for today
-        today = datetime.now().date()
-        diary_today = diary[diary["date"].dt.date == today]
-        diary = diary[diary["date"].dt.date != today]
         file_id = update.message.photo[-1].file_id
-        if len(diary_today) > 0:
-            # if there is already an entry for today, append the new photo to the existing entry
-            logger.info(f"Entry for today already exists: {diary_today}")
-            diary_today["images"] = [
-                diary_today["images"].values[0] + [file_id + ".jpeg"]
-            ]
-            df = diary_today
-        else:
-            # if there is no entry for today, create a new entry
-            logger.info("No entry for today exists")
-            df = create_diary_entry("")
-            df["images"] = [[file_id + ".jpeg"]]
         # save image to disk
         image = await context.bot.get_file(file_id)
+        Path(config.get("image_dir")).mkdir(parents=True, exist_ok=True)
         await image.download_to_drive(
             Path(config.get("image_dir")) / Path(file_id + ".jpeg")
         )
-        df = add_embedding(df)
-        # append the new entry to the diary
-        diary = pd.concat([diary, df])
-        # save the diary
-        save_diary(diary, config)
+        await submit_update({"image": file_id + ".jpeg"}, config)
+        notify_embedding_worker(config)
         await context.bot.send_message(
             chat_id=update.message.chat_id, text="Your photo has been saved."
         )
@@ -165,3 +222,52 @@ def correct_chat(chat_id, config):
     check = int(config.get("chat_id")) == chat_id
     logger.info(f"Correct chat: {check}")
     return check
+
+
+_chat_configs = {}
+
+
+def chat_config(config, chat_id):
+    """Get the config of the diary belonging to the given chat.
+
+    The chat in `chat_id` uses the paths of the main config, every chat listed
+    in `diaries` gets its own storage below `diaries_dir`. Unknown chats get the
+    main config, so `correct_chat` rejects them.
+    """
+    if chat_id is None or int(config.get("chat_id")) == chat_id:
+        return config
+    diaries = config.get("diaries", {})
+    if str(chat_id) not in diaries:
+        return config
+    if chat_id not in _chat_configs:
+        base = Path(config.get("diaries_dir", "data/diaries")) / str(chat_id)
+        overrides = {
+            "chat_id": chat_id,
+            "diary_csv": str(base / "tagebuch.csv"),
+            "embedding_file": str(base / "embeddings.npy"),
+            "image_dir": str(base / "images"),
+            "data_dir": str(base),
+        }
+        overrides.update(diaries[str(chat_id)] or {})
+        _chat_configs[chat_id] = ConfigFactory.from_dict(overrides).with_fallback(
+            config
+        )
+    return _chat_configs[chat_id]
+
+
+def all_chat_configs(config):
+    """Configs of all diaries, the main one first."""
+    return [config] + [
+        chat_config(config, int(chat_id)) for chat_id in config.get("diaries", {})
+    ]
+
+
+def for_chat(callback, config):
+    """Wraps a handler so it gets the config of the chat the update came from."""
+
+    @wraps(callback)
+    async def handler(update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        return await callback(update, context, config=chat_config(config, chat_id))
+
+    return handler
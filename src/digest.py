@@ -0,0 +1,106 @@
+import json
+import logging
+import random
+from datetime import date as date_, timedelta
+from pathlib import Path
+
+from diary import get_diary
+from neighbours import entry_keys, get_neighbours
+from search import MAX_LENGTH, closest_entries_message
+from sender import send_photos
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+# digests older than this are removed when a new one is stored
+KEEP_DAYS = 7
+
+
+def _digest_dir(config):
+    return Path(config.get("data_dir")) / "digests"
+
+
+def build_digest(day, config):
+    """Prepare the "on this day" message for day from the entries of past years."""
+    diary = get_diary(config)
+    on_this_day = diary[
+        (diary["date"].dt.day == day.day)
+        & (diary["date"].dt.month == day.month)
+        & (diary["date"].dt.year != day.year)
+    ]
+    digest = {"day": day.isoformat(), "count": len(on_this_day)}
+    if len(on_this_day) == 0:
+        return digest
+    # if there are multiple entries for the day choose one
+    entry = on_this_day.sample()
+    entry_date = entry["date"].values[0]
+    text = (
+        f"There are {len(on_this_day)} entries for today. \n"
+        f"Here is what you wrote in {entry['date'].dt.date.values[0]}:\n\n"
+        + entry["entry"].values[0]
+    )
+    images = entry["images"].values[0]
+    digest.update(
+        {
+            "entry_date": str(entry["date"].dt.date.values[0]),
+            "chunks": [text[i : i + MAX_LENGTH] for i in range(0, len(text), MAX_LENGTH)],
+            "image": random.choice(images) if len(images) > 0 else None,
+            "links": closest_entries_message(entry_date, diary)
+            + related_entries_message(entry, diary, config),
+        }
+    )
+    return digest
+
+
+def related_entries_message(entry, diary, config, n=3):
+    """Links to the most similar entries from the neighbour graph."""
+    key = entry_keys(diary["date"])[diary.index.get_loc(entry.index[0])]
+    related = get_neighbours(diary, key, n, config)
+    if related is None or len(related) == 0:
+        return ""
+    dates = " ".join(f"/{date.strftime('%d_%m_%Y')}" for date in related["date"])
+    return f"\nRelated: {dates}"
+
+
+def store_digest(digest, config):
+    directory = _digest_dir(config)
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / f"{digest['day']}.json").write_text(json.dumps(digest))
+    oldest = (date_.fromisoformat(digest["day"]) - timedelta(days=KEEP_DAYS)).isoformat()
+    for path in directory.glob("*.json"):
+        if path.stem < oldest:
+            path.unlink()
+
+
+def get_digest(day, config):
+    """Get the stored digest for day, it is built and stored if it is missing."""
+    path = _digest_dir(config) / f"{day.isoformat()}.json"
+    if path.exists():
+        return json.loads(path.read_text())
+    logger.info(f"No digest prepared for {day}, building it")
+    digest = build_digest(day, config)
+    store_digest(digest, config)
+    return digest
+
+
+def prepare_digest(day, config):
+    """Build and store the digest for day, so it can be sent without loading the diary."""
+    digest = build_digest(day, config)
+    store_digest(digest, config)
+    logger.info(f"Prepared digest for {day} with {digest['count']} entries")
+    return digest
+
+
+async def send_digest(digest, bot, chat_id, config):
+    """Send a digest, returns False if there was nothing written on that day."""
+    if digest["count"] == 0:
+        return False
+    for chunk in digest["chunks"]:
+        await bot.send_message(chat_id=chat_id, text=chunk)
+    if digest["image"]:
+        await send_photos(bot, chat_id, [digest["image"]], config)
+    await bot.send_message(chat_id=chat_id, text=digest["links"])
+    return True
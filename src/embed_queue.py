@@ -0,0 +1,260 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from neighbours import entry_keys
+from openai_tools import get_embeddings
+from passages import indexed_keys, plan_passages, split_passages
+from store import get_store
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_workers = {}
+
+
+def queue_path(config):
+    return Path(config.get("embedding_file")).with_name("embedding_queue.json")
+
+
+def _read(config):
+    path = queue_path(config)
+    return json.loads(path.read_text()) if path.exists() else {}
+
+
+def _write(config, jobs):
+    # write to a temporary file first, so a crash never leaves half a queue
+    path = queue_path(config)
+    if not jobs:
+        # no file means nothing to do, so a restart does not open the diary
+        path.unlink(missing_ok=True)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(jobs))
+    os.replace(tmp, path)
+
+
+def enqueue(config, keys, passages_only=False):
+    """Queue the entries with the given keys for embedding.
+
+    Every job carries a version, so an entry that changes again while it is
+    embedded stays in the queue. With passages_only the stored embedding of
+    the entry is current and only its passages are embedded.
+    """
+    with _lock:
+        jobs = _read(config)
+        for key in keys:
+            job = jobs.get(key)
+            version = 1 if job is None else job["version"] + 1
+            jobs[key] = {"version": version, "attempts": 0, "next_try": 0}
+            # a job for the whole entry stays one
+            if passages_only and (job is None or job.get("passages_only")):
+                jobs[key]["passages_only"] = True
+        _write(config, jobs)
+
+
+def passages_only(config, keys):
+    """The queued keys whose entry only needs its passages embedded."""
+    with _lock:
+        jobs = _read(config)
+    return {key for key in keys if jobs.get(key, {}).get("passages_only")}
+
+
+def has_jobs(config):
+    """Whether the queue holds jobs that are not parked as failed."""
+    with _lock:
+        jobs = _read(config)
+    return any(not job.get("failed") for job in jobs.values())
+
+
+def take(config, batch_size):
+    """Get up to batch_size due jobs as {key: version} and the seconds until the next one is due.
+
+    Failed jobs are left out until their entry is queued again.
+    """
+    with _lock:
+        jobs = _read(config)
+    jobs = {key: job for key, job in jobs.items() if not job.get("failed")}
+    now = time.time()
+    due = {key: job["version"] for key, job in jobs.items() if job["next_try"] <= now}
+    later = [job["next_try"] - now for job in jobs.values() if job["next_try"] > now]
+    return dict(list(due.items())[:batch_size]), min(later, default=None)
+
+
+def complete(config, taken):
+    """Remove finished jobs unless their entry was queued again meanwhile."""
+    with _lock:
+        jobs = _read(config)
+        for key, version in taken.items():
+            if key in jobs and jobs[key]["version"] == version:
+                del jobs[key]
+        _write(config, jobs)
+
+
+def retry_later(config, taken, base=5, max_backoff=3600, max_attempts=8):
+    """Back off exponentially for jobs whose embedding failed.
+
+    After max_attempts a job is parked as failed, returns the parked keys.
+    """
+    failed = []
+    with _lock:
+        jobs = _read(config)
+        for key in taken:
+            if key in jobs:
+                attempts = jobs[key]["attempts"] + 1
+                jobs[key]["attempts"] = attempts
+                jobs[key]["next_try"] = time.time() + min(base * 2 ** (attempts - 1), max_backoff)
+                if attempts >= max_attempts:
+                    jobs[key]["failed"] = True
+                    failed.append(key)
+        _write(config, jobs)
+    return failed
+
+
+def backfill(config):
+    """Queue every entry that has no embedding or no passages yet."""
+    diary = get_store(config).get(config)
+    embeddings = diary["embedding"] if "embedding" in diary.columns else [None] * len(diary)
+    with _lock:
+        queued = _read(config)
+    passaged = indexed_keys(config)
+    missing, unpassaged = [], []
+    for key, text, embedding in zip(entry_keys(diary["date"]), diary["entry"], embeddings):
+        if key in queued:
+            continue
+        if not isinstance(embedding, np.ndarray):
+            missing.append(key)
+        elif key not in passaged and split_passages(text):
+            unpassaged.append(key)
+    if missing:
+        logger.info(f"Queueing {len(missing)} entries without embedding")
+        enqueue(config, missing)
+    if unpassaged:
+        logger.info(f"Queueing the passages of {len(unpassaged)} entries")
+        enqueue(config, unpassaged, passages_only=True)
+
+
+def pending_texts(config, keys):
+    """Texts of the queued entries, entries that no longer exist are left out."""
+    diary = get_store(config).get(config)
+    texts = dict(zip(entry_keys(diary["date"]), diary["entry"]))
+    return {key: texts[key] for key in keys if key in texts}
+
+
+def _bad_input(error):
+    """Whether the request was refused for its input, e.g. a text that is too long.
+
+    Rate limits and authentication errors affect every entry alike.
+    """
+    status = getattr(error, "status_code", None)
+    return status is not None and 400 <= status < 500 and status not in (401, 403, 429)
+
+
+class EmbeddingWorker:
+    """Drains the embedding queue of one diary in batches.
+
+    The entries and their new passages are embedded with one request. The
+    embeddings are handed to `write`, which stores them through the write
+    queue of the diary, so they never race with new messages.
+    """
+
+    def __init__(self, config, write):
+        self.config = config
+        self.write = write
+        self.batch_size = config.get("embedding_queue.batch_size", 32)
+        self.poll_interval = config.get("embedding_queue.poll_interval", 60)
+        self.max_backoff = config.get("embedding_queue.max_backoff", 3600)
+        self.max_attempts = config.get("embedding_queue.max_attempts", 8)
+        self._wake = asyncio.Event()
+        self._task = None
+        self._backfill = False
+        self._backfilled = False
+
+    def notify(self, backfill=True):
+        """Start the worker if needed and let it look at the queue.
+
+        The diary is checked for entries without embedding once, on the first
+        notify with backfill, i.e. when the diary is first used.
+        """
+        if backfill and not self._backfilled:
+            self._backfill = self._backfilled = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            if self._backfill:
+                self._backfill = False
+                await asyncio.to_thread(backfill, self.config)
+            taken, wait = await asyncio.to_thread(take, self.config, self.batch_size)
+            if taken:
+                await self._process(taken)
+                continue
+            if wait is None:
+                if self._wake.is_set():
+                    continue
+                # nothing queued, notify starts the worker again
+                return
+            timeout = min(wait, self.poll_interval)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _process(self, taken):
+        try:
+            texts = await asyncio.to_thread(pending_texts, self.config, list(taken))
+            only = await asyncio.to_thread(passages_only, self.config, list(texts))
+            entries = {key: text for key, text in texts.items() if key not in only}
+            plan, new = await asyncio.to_thread(plan_passages, self.config, texts)
+            vectors = await asyncio.to_thread(
+                get_embeddings, list(entries.values()) + list(new.values())
+            )
+            embedded = dict(zip(entries, vectors))
+            passage_vectors = dict(zip(new, vectors[len(entries):]))
+            await self.write(
+                {
+                    # None keeps the stored embedding of the entry
+                    "embeddings": {key: (text, embedded.get(key)) for key, text in texts.items()},
+                    "passages": {
+                        key: [(s, e, h, passage_vectors.get(h)) for s, e, h in plan[key]]
+                        for key in texts
+                    },
+                }
+            )
+        except Exception as e:
+            if len(taken) > 1 and _bad_input(e):
+                # one entry the model refuses must not hold back the others
+                logger.warning(f"Embedding {len(taken)} entries was refused, embedding them one by one: {e}")
+                for key, version in taken.items():
+                    await self._process({key: version})
+                return
+            logger.error(f"Embedding {len(taken)} entries failed, retrying later: {e}")
+            failed = await asyncio.to_thread(
+                retry_later, self.config, taken, max_backoff=self.max_backoff, max_attempts=self.max_attempts
+            )
+            if failed:
+                logger.error(f"Gave up embedding {', '.join(failed)} after {self.max_attempts} attempts")
+        else:
+            logger.info(f"Embedded {len(entries)} entries and {len(new)} passages")
+            await asyncio.to_thread(complete, self.config, taken)
+
+
+def get_embedding_worker(config, write):
+    key = config.get("diary_csv")
+    if key not in _workers:
+        _workers[key] = EmbeddingWorker(config, write)
+    return _workers[key]
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import logging
+from pathlib import Path
+
+from telegram.error import BadRequest
+
+from profiler import current
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+# seconds between two edits of a progress message
+PROGRESS_INTERVAL = 2.0
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class BackgroundJob:
+    """A heavy command running in the background with a progress message."""
+
+    def __init__(self, key, title, chat_id, bot):
+        self.key = key
+        self.title = title
+        self.chat_id = chat_id
+        self.bot = bot
+        self.status = "started"
+        self.cancelled = False
+        self.message = None
+        self.task = None
+        # done, cancelled or failed once the job has finished
+        self.outcome = None
+        self.error = None
+
+    def progress(self, status):
+        """Report progress, safe to call from worker threads.
+
+        Raises JobCancelled once the job was cancelled, so long running work
+        stops at the next progress report.
+        """
+        if self.cancelled:
+            raise JobCancelled(self.title)
+        self.status = status
+
+    async def _edit(self, text):
+        try:
+            await self.bot.edit_message_text(
+                text=text, chat_id=self.chat_id, message_id=self.message.message_id
+            )
+        except BadRequest as e:
+            # telegram refuses edits that do not change the text
+            logger.debug(e)
+
+    async def _show_progress(self):
+        shown = None
+        while True:
+            if self.status != shown:
+                shown = self.status
+                await self._edit(f"⏳ {self.title}: {shown}")
+            await asyncio.sleep(PROGRESS_INTERVAL)
+
+    async def run(self, work):
+        self.message = await self.bot.send_message(
+            chat_id=self.chat_id, text=f"⏳ {self.title}: {self.status}"
+        )
+        ticker = asyncio.create_task(self._show_progress())
+        try:
+            await work(self)
+        except (asyncio.CancelledError, JobCancelled):
+            self.outcome = "cancelled"
+            result = f"❌ {self.title}: cancelled"
+        except Exception as e:
+            logger.exception(f"{self.title} failed")
+            self.outcome, self.error = "failed", e
+            result = f"⚠️ {self.title}: failed ({e})"
+        else:
+            self.outcome = "done"
+            result = f"✅ {self.title}: done"
+        finally:
+            ticker.cancel()
+        await self._edit(result)
+
+
+class JobManager:
+    """Runs heavy commands as tracked background tasks.
+
+    A job is identified by a key, e.g. chat, command and arguments. Starting a
+    job while the same one is still running does not start it again.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+
+    async def start(self, key, title, chat_id, bot, work):
+        """Start work(job) in the background, returns False if it is already running."""
+        if key in self._jobs:
+            await bot.send_message(chat_id=chat_id, text=f"{title} is already running.")
+            return False
+        job = BackgroundJob(key, title, chat_id, bot)
+        self._jobs[key] = job
+        capture = current()
+        if capture is None:
+            job.task = asyncio.create_task(job.run(work))
+        else:
+            # a profiled command runs on in the background job
+            job.task = asyncio.create_task(capture.profile_steps(job.run(work)))
+            capture.track(job.task)
+        job.task.add_done_callback(lambda _: self._jobs.pop(key, None))
+        return True
+
+    def cancel(self, chat_id):
+        """Cancel all jobs of a chat, returns the number of cancelled jobs."""
+        jobs = [job for job in self._jobs.values() if job.chat_id == chat_id]
+        for job in jobs:
+            job.cancelled = True
+            job.task.cancel()
+        return len(jobs)
+
+    def running(self, chat_id):
+        return [job for job in self._jobs.values() if job.chat_id == chat_id]
+
+
+job_manager = JobManager()
+
+
+def _schedules_path(config):
+    return Path(config.get("data_dir")) / "schedules.json"
+
+
+def load_schedules(config):
+    """Names of the scheduled jobs of a diary, e.g. daily or monthly_report."""
+    path = _schedules_path(config)
+    return json.loads(path.read_text()) if path.exists() else []
+
+
+def add_schedule(config, name):
+    schedules = load_schedules(config)
+    if name not in schedules:
+        path = _schedules_path(config)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(schedules + [name]))
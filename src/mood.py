@@ -0,0 +1,141 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+# word forms with a polarity between -1 and 1, German first since most entries are German
+LEXICON = {
+    # German positive
+    "gut": 0.5, "gute": 0.5, "guter": 0.5, "gutes": 0.5, "guten": 0.5, "besser": 0.6, "beste": 0.8, "besten": 0.8,
+    "schön": 0.7, "schöne": 0.7, "schöner": 0.7, "schönen": 0.7, "schönes": 0.7, "wunderschön": 1.0,
+    "toll": 0.8, "tolle": 0.8, "toller": 0.8, "tollen": 0.8, "super": 0.8, "genial": 0.9, "großartig": 1.0,
+    "wunderbar": 1.0, "herrlich": 0.9, "perfekt": 0.9, "glücklich": 1.0, "glückliche": 1.0, "glück": 0.8,
+    "froh": 0.8, "fröhlich": 0.8, "freude": 0.8, "freue": 0.7, "gefreut": 0.7, "freuen": 0.7, "freut": 0.7,
+    "lachen": 0.6, "gelacht": 0.6, "lustig": 0.6, "spaß": 0.7, "liebe": 0.8, "lieben": 0.8, "geliebt": 0.8,
+    "zufrieden": 0.7, "entspannt": 0.6, "entspannend": 0.6, "ruhig": 0.3, "erholt": 0.6, "erholsam": 0.6,
+    "dankbar": 0.8, "stolz": 0.6, "erfolgreich": 0.7, "erfolg": 0.7, "geschafft": 0.6, "gelungen": 0.6,
+    "genossen": 0.7, "genießen": 0.7, "lecker": 0.5, "gemütlich": 0.5, "angenehm": 0.5, "spannend": 0.4,
+    "interessant": 0.4, "motiviert": 0.6, "energie": 0.3, "aufgeregt": 0.2, "begeistert": 0.9, "hoffnung": 0.5,
+    "sonnig": 0.4, "sonne": 0.3, "feiern": 0.6, "gefeiert": 0.6, "geburtstag": 0.3, "urlaub": 0.5,
+    # German negative
+    "schlecht": -0.6, "schlechte": -0.6, "schlechter": -0.6, "schlechten": -0.6, "schlimm": -0.8,
+    "schlimmer": -0.8, "furchtbar": -0.9, "schrecklich": -0.9, "traurig": -0.8, "trauer": -0.8,
+    "weinen": -0.7, "geweint": -0.7, "angst": -0.8, "ängstlich": -0.7, "sorgen": -0.6, "sorge": -0.6,
+    "stress": -0.6, "stressig": -0.6, "gestresst": -0.6, "müde": -0.4, "erschöpft": -0.7, "krank": -0.7,
+    "schmerzen": -0.7, "kopfschmerzen": -0.6, "wütend": -0.8, "wut": -0.8, "ärger": -0.6, "geärgert": -0.6,
+    "ärgerlich": -0.6, "genervt": -0.6, "nervig": -0.5, "langweilig": -0.4, "einsam": -0.8, "allein": -0.3,
+    "enttäuscht": -0.7, "enttäuschung": -0.7, "frustriert": -0.7, "frust": -0.6, "streit": -0.7,
+    "gestritten": -0.7, "problem": -0.4, "probleme": -0.4, "schwierig": -0.4, "schwer": -0.3, "hart": -0.3,
+    "verloren": -0.5, "verletzt": -0.6, "unglücklich": -0.9, "unzufrieden": -0.7, "nervös": -0.5,
+    "hasse": -0.9, "hass": -0.9, "kaputt": -0.5, "regen": -0.2, "verpasst": -0.4, "fehler": -0.4,
+    "leider": -0.4, "blöd": -0.5, "doof": -0.5, "mies": -0.7, "deprimiert": -0.9, "überfordert": -0.7,
+    # English
+    "good": 0.5, "great": 0.8, "nice": 0.5, "happy": 1.0, "glad": 0.7, "love": 0.8, "loved": 0.8,
+    "wonderful": 1.0, "amazing": 0.9, "awesome": 0.8, "beautiful": 0.7, "fun": 0.7, "enjoyed": 0.7,
+    "relaxed": 0.6, "grateful": 0.8, "proud": 0.6, "excited": 0.6, "better": 0.6, "best": 0.8,
+    "bad": -0.6, "worse": -0.7, "worst": -0.9, "sad": -0.8, "angry": -0.8, "tired": -0.4, "sick": -0.7,
+    "stressed": -0.6, "anxious": -0.7, "afraid": -0.7, "lonely": -0.8, "hate": -0.9, "terrible": -0.9,
+    "awful": -0.9, "annoyed": -0.6, "disappointed": -0.7, "cried": -0.7, "upset": -0.7, "boring": -0.4,
+}
+# a negation flips the polarity of the word right after it
+NEGATIONS = ["nicht", "kein", "keine", "keinen", "keiner", "nie", "niemals", "not", "no", "never"]
+NEGATION = r"\b(?:" + "|".join(NEGATIONS) + r")\s+(\w+)"
+
+
+def load_lexicon(path):
+    """Read a lexicon file with `word<TAB>weight` lines.
+
+    SentiWS files work as well, `word|POS<TAB>weight<TAB>inflections`.
+    """
+    lexicon = {}
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        parts = line.strip().split("\t")
+        if len(parts) < 2:
+            continue
+        weight = float(parts[1])
+        words = [parts[0].split("|")[0]] + (parts[2].split(",") if len(parts) > 2 else [])
+        for word in words:
+            if word:
+                lexicon[word.lower()] = weight
+    return lexicon
+
+
+def get_lexicon(config):
+    lexicon = dict(LEXICON)
+    for path in config.get("mood.lexicons", []):
+        lexicon.update(load_lexicon(path))
+    return lexicon
+
+
+def score_entries(entries, lexicon):
+    """Mood of every entry, the mean polarity of its lexicon words.
+
+    Returns the scores, NaN where no word of the lexicon occurs, and the
+    number of lexicon words per entry.
+    """
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    words = sorted(lexicon)
+    vocabulary = words + [w + "_neg" for w in words]
+    weights = np.array([lexicon[w] for w in words] * 2, dtype=np.float32)
+    weights[len(words):] *= -1
+    # "nicht gut" is counted as gut_neg
+    text = pd.Series(entries, dtype=object).fillna("").str.lower().str.replace(NEGATION, r"\1_neg", regex=True)
+    counts = CountVectorizer(vocabulary=vocabulary, token_pattern=r"(?u)\b\w+\b").transform(text)
+    hits = np.asarray(counts.sum(axis=1)).ravel()
+    total = counts @ weights
+    with np.errstate(invalid="ignore", divide="ignore"):
+        scores = np.where(hits > 0, total / hits, np.nan)
+    return scores, hits
+
+
+def _content_hash(text):
+    return hashlib.sha1(str(text).encode()).hexdigest()
+
+
+def _cache_path(config):
+    return Path(config.get("data_dir")) / "mood.json"
+
+
+def get_mood(diary, config):
+    """Date and mood of every entry.
+
+    Scores are cached per entry content, only new and changed entries are
+    scored. Changing the lexicon scores everything again.
+    """
+    lexicon = get_lexicon(config)
+    version = _content_hash(json.dumps(lexicon, sort_keys=True))
+    path = _cache_path(config)
+    cache = json.loads(path.read_text()) if path.exists() else {}
+    scores = cache.get("scores", {}) if cache.get("lexicon") == version else {}
+    hashes = [_content_hash(text) for text in diary["entry"]]
+    missing = [i for i, h in enumerate(hashes) if h not in scores]
+    if missing:
+        new_scores, new_hits = score_entries(diary["entry"].values[missing], lexicon)
+        for i, score, hits in zip(missing, new_scores, new_hits):
+            scores[hashes[i]] = [None if np.isnan(score) else float(score), int(hits)]
+        logger.info(f"Scored the mood of {len(missing)} of {len(hashes)} entries")
+    # keep the cache to the current entries
+    scores = {h: scores[h] for h in hashes}
+    if missing or len(scores) != len(cache.get("scores", {})):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"lexicon": version, "scores": scores}))
+        os.replace(tmp, path)
+    return pd.DataFrame(
+        {
+            "date": diary["date"].values,
+            "mood": [np.nan if scores[h][0] is None else scores[h][0] for h in hashes],
+            "words": [scores[h][1] for h in hashes],
+        }
+    )
@@ -0,0 +1,184 @@
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+# rows of the similarity matrix computed at once
+BLOCK_SIZE = 1024
+
+
+def entry_keys(dates):
+    """Key every entry by its day, repeated days get a running number."""
+    keys = []
+    seen = {}
+    for day in dates.dt.strftime("%Y-%m-%d"):
+        seen[day] = seen.get(day, 0) + 1
+        keys.append(day if seen[day] == 1 else f"{day}#{seen[day]}")
+    return keys
+
+
+def embedding_matrix(diary):
+    """Stack the embeddings as normalized float32 rows, entries without one are left out."""
+    keys = entry_keys(diary["date"])
+    rows, vectors = [], []
+    if "embedding" in diary.columns:
+        for key, embedding in zip(keys, diary["embedding"].values):
+            if isinstance(embedding, (np.ndarray, list)):
+                rows.append(key)
+                vectors.append(np.asarray(embedding, dtype=np.float32).reshape(-1))
+    if not vectors:
+        return rows, np.zeros((0, 0), dtype=np.float32)
+    matrix = np.vstack(vectors)
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    return rows, matrix
+
+
+def _top_k(sims, k):
+    """Indices and scores of the k largest values of every row, best first."""
+    indices = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    scores = np.take_along_axis(sims, indices, axis=1)
+    order = np.argsort(-scores, axis=1)
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+
+def _neighbours_of(rows, matrix, k):
+    """Exact top-k neighbours of the given rows, computed block by block."""
+    indices = np.zeros((len(rows), k), dtype=np.int32)
+    scores = np.zeros((len(rows), k), dtype=np.float32)
+    for start in range(0, len(rows), BLOCK_SIZE):
+        block = rows[start : start + BLOCK_SIZE]
+        sims = matrix[block] @ matrix.T
+        # an entry is not its own neighbour
+        sims[np.arange(len(block)), block] = -np.inf
+        indices[start : start + len(block)], scores[start : start + len(block)] = _top_k(sims, k)
+    return indices, scores
+
+
+def build_graph(keys, matrix, k):
+    """All-pairs top-k neighbour graph of the normalized embedding matrix."""
+    k = min(k, len(keys) - 1)
+    if k < 1:
+        return {
+            "keys": list(keys),
+            "indices": np.zeros((len(keys), 0), dtype=np.int32),
+            "scores": np.zeros((len(keys), 0), dtype=np.float32),
+        }
+    indices, scores = _neighbours_of(np.arange(len(keys)), matrix, k)
+    return {"keys": list(keys), "indices": indices, "scores": scores}
+
+
+def update_graph(graph, keys, matrix, changed, k):
+    """Update the graph for new entries and entries whose embedding changed.
+
+    Rows of changed entries and rows that pointed to one of them are computed
+    again, all other rows only compare against the changed entries.
+    """
+    old_keys = graph["keys"]
+    position = {key: i for i, key in enumerate(keys)}
+    k_new = min(k, len(keys) - 1)
+    if graph["indices"].shape[1] != k_new or any(key not in position for key in old_keys):
+        return build_graph(keys, matrix, k)
+    # move the old graph to the new positions
+    remap = np.array([position[key] for key in old_keys], dtype=np.int32)
+    indices = np.zeros((len(keys), k_new), dtype=np.int32)
+    scores = np.full((len(keys), k_new), -np.inf, dtype=np.float32)
+    indices[remap] = remap[graph["indices"]]
+    scores[remap] = graph["scores"]
+
+    new = set(keys) - set(old_keys)
+    changed = np.array(sorted({position[key] for key in set(changed) | new if key in position}), dtype=np.int32)
+    if len(changed) == 0:
+        return {"keys": list(keys), "indices": indices, "scores": scores}
+    is_changed = np.zeros(len(keys), dtype=bool)
+    is_changed[changed] = True
+    is_new = np.zeros(len(keys), dtype=bool)
+    is_new[[position[key] for key in new]] = True
+    # rows of changed entries and rows that lost a neighbour are computed again
+    stale = is_changed | is_new | is_changed[indices].any(axis=1)
+    recompute = np.flatnonzero(stale)
+    indices[recompute], scores[recompute] = _neighbours_of(recompute, matrix, k_new)
+
+    rest = np.flatnonzero(~stale)
+    if len(rest) > 0:
+        candidates = (matrix[changed] @ matrix[rest].T).T
+        merged_scores = np.concatenate([scores[rest], candidates], axis=1)
+        merged_indices = np.concatenate([indices[rest], np.broadcast_to(changed, candidates.shape)], axis=1)
+        top, scores[rest] = _top_k(merged_scores, k_new)
+        indices[rest] = np.take_along_axis(merged_indices, top, axis=1)
+    return {"keys": list(keys), "indices": indices, "scores": scores}
+
+
+def graph_path(config):
+    return Path(config.get("embedding_file")).with_name("neighbours.npz")
+
+
+def load_graph(config):
+    path = graph_path(config)
+    if not path.exists():
+        return None
+    data = np.load(path)
+    return {"keys": data["keys"].tolist(), "indices": data["indices"], "scores": data["scores"]}
+
+
+def save_graph(graph, config):
+    # write to a temporary file first, readers in other threads never see half a graph
+    path = graph_path(config)
+    tmp = path.with_suffix(".tmp.npz")
+    np.savez(
+        tmp,
+        keys=np.array(graph["keys"], dtype=str),
+        indices=graph["indices"],
+        scores=graph["scores"],
+    )
+    os.replace(tmp, path)
+
+
+def update_neighbours(diary, config, changed=()):
+    """Bring the stored neighbour graph up to date with the diary."""
+    keys, matrix = embedding_matrix(diary)
+    k = config.get("neighbours", 5)
+    graph = load_graph(config)
+    if graph is None:
+        logger.info(f"Building neighbour graph for {len(keys)} entries")
+        graph = build_graph(keys, matrix, k)
+    else:
+        graph = update_graph(graph, keys, matrix, changed, k)
+    save_graph(graph, config)
+    return graph
+
+
+def get_neighbours(diary, key, n, config):
+    """Get the n most similar entries of the entry with key from the graph.
+
+    Returns None if the graph can not answer, e.g. if n is larger than the
+    number of stored neighbours.
+    """
+    graph = load_graph(config)
+    if graph is None or key not in graph["keys"] or n > graph["indices"].shape[1]:
+        return None
+    row = graph["keys"].index(key)
+    positions = {k: i for i, k in enumerate(entry_keys(diary["date"]))}
+    found = [
+        (positions[graph["keys"][i]], score)
+        for i, score in zip(graph["indices"][row][:n], graph["scores"][row][:n])
+        if graph["keys"][i] in positions
+    ]
+    results = diary.iloc[[i for i, _ in found]].copy()
+    results["similarity"] = [score for _, score in found]
+    return results
+
+
+def related_keys(config, n=3):
+    """Map every entry key to the keys of its n most similar entries."""
+    graph = load_graph(config)
+    if graph is None:
+        return {}
+    keys = graph["keys"]
+    return {key: [keys[i] for i in row[:n]] for key, row in zip(keys, graph["indices"])}
@@ -1,8 +1,7 @@
-from openai import OpenAI
-from sklearn.metrics.pairwise import cosine_similarity
-import numpy as np
 import logging
 
+import numpy as np
+
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
@@ -11,29 +10,76 @@ logger = logging.getLogger(__name__)
 
 
 def get_embedding(text, model="text-embedding-3-large"):
+   from openai import OpenAI
+
    text = text.replace("\n", " ")
    client = OpenAI()
    embed = client.embeddings.create(input = [text], model=model).data[0].embedding
    return np.array(embed).reshape(1, -1)
 
 
-def add_embedding(df, model="text-embedding-3-large"):
-    df["embedding"] = df["entry"].apply(lambda x: get_embedding(x, model=model))
-    return df
+# the model reads at most 8191 tokens per input, diary text has about three characters per token
+MAX_INPUT_CHARS = 20000
+# a request holds at most 2048 inputs and 300,000 tokens
+MAX_REQUEST_INPUTS = 2048
+MAX_REQUEST_CHARS = 600000
 
 
-def search_entries(df, search, n=3, pprint=False):
-    embed = get_embedding(search)
-    results = get_similar_entries(df, embed, n=n)
-    if pprint:
-        for r in results.entry.values:
-            print(r)
-            print()
-    return results
+def split_input(text, size=MAX_INPUT_CHARS):
+    """Cut a text into chunks the model reads completely, at whitespace if possible."""
+    chunks = []
+    while len(text) > size:
+        cut = text.rfind(" ", size // 2, size)
+        cut = cut if cut > 0 else size
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip()
+    return chunks + [text]
+
+
+def get_embeddings(texts, model="text-embedding-3-large"):
+    """Embed several texts with as few requests as possible.
+
+    Texts longer than the model reads are embedded in chunks, their
+    embedding is the mean of the chunks weighted by length.
+    """
+    from openai import OpenAI
+
+    if not texts:
+        return []
+    chunks, owner = [], []
+    for i, text in enumerate(texts):
+        for chunk in split_input(text.replace("\n", " "), MAX_INPUT_CHARS):
+            chunks.append(chunk)
+            owner.append(i)
+    requests, size = [[]], 0
+    for j, chunk in enumerate(chunks):
+        if requests[-1] and (len(requests[-1]) == MAX_REQUEST_INPUTS or size + len(chunk) > MAX_REQUEST_CHARS):
+            requests.append([])
+            size = 0
+        requests[-1].append(j)
+        size += len(chunk)
+    client = OpenAI()
+    vectors = []
+    for request in requests:
+        data = client.embeddings.create(input=[chunks[j] for j in request], model=model).data
+        vectors += [np.array(d.embedding, dtype=np.float32) for d in sorted(data, key=lambda d: d.index)]
+    parts = [[] for _ in texts]
+    for j, i in enumerate(owner):
+        parts[i].append(j)
+    return [
+        np.average([vectors[j] for j in rows], axis=0, weights=[max(len(chunks[j]), 1) for j in rows])
+        .astype(np.float32)
+        .reshape(1, -1)
+        for rows in parts
+    ]
 
 
 def get_similar_entries(df, embed, n=3):
+    from sklearn.metrics.pairwise import cosine_similarity
+
     n = int(n)
+    # entries whose embedding is still pending are skipped
+    df = df[df.embedding.apply(lambda x: isinstance(x, np.ndarray))].copy()
     df["similarity"] = df.embedding.apply(lambda x: cosine_similarity(x, embed))
     results = df.sort_values("similarity", ascending=False).head(n + 1).iloc[1:]
     return results
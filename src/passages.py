@@ -0,0 +1,321 @@
+import hashlib
+import html
+import logging
+import os
+import re
+import uuid
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+
+from store import get_store
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+# an entry is split at the time markers of create_diary_entry and at blank lines
+BOUNDARY = re.compile(r"(?m)^--\s*\d{1,2}:\d{2}\s*--\s*$|\n\s*\n")
+SENTENCE = re.compile(r"[^.!?\n]+[.!?]*")
+WORD = re.compile(r"\w{3,}")
+# shorter passages are merged into the one before
+MIN_CHARS = 80
+MAX_CHARS = 800
+CONTEXT_CHARS = 300
+# from this many rows on, the vector file is rewritten once more than half of them are unused
+COMPACT_ROWS = 1000
+
+
+def split_passages(text):
+    """Split an entry into passages, returns (start, end) offsets into text."""
+    cuts = [0]
+    for match in BOUNDARY.finditer(text):
+        cuts += [match.start(), match.end()] if match.group().strip() else [match.end()]
+    cuts.append(len(text))
+    spans = []
+    for start, end in zip(cuts, cuts[1:]):
+        # strip whitespace and skip the time markers themselves
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if end - start == 0 or BOUNDARY.fullmatch(text[start:end]):
+            continue
+        spans += _limit(text, start, end)
+    passages = []
+    for start, end in spans:
+        if passages and (end - start < MIN_CHARS or passages[-1][1] - passages[-1][0] < MIN_CHARS) and end - passages[-1][0] <= MAX_CHARS:
+            passages[-1] = (passages[-1][0], end)
+        else:
+            passages.append((start, end))
+    return passages
+
+
+def _limit(text, start, end):
+    """Cut a long span at sentence ends so no passage exceeds MAX_CHARS."""
+    spans = []
+    while end - start > MAX_CHARS:
+        cut = max(text.rfind(". ", start, start + MAX_CHARS), text.rfind("\n", start, start + MAX_CHARS))
+        cut = cut + 1 if cut > start else start + MAX_CHARS
+        spans.append((start, cut))
+        start = cut
+        while start < end and text[start].isspace():
+            start += 1
+    if end > start:
+        spans.append((start, end))
+    return spans
+
+
+def passage_hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def passages_path(config):
+    return Path(config.get("embedding_file")).with_name("passages.npz")
+
+
+def _vectors_path(config, index):
+    return passages_path(config).with_name(str(index["vectors"]))
+
+
+def _new_file():
+    return f"passages-{uuid.uuid4().hex[:8]}.f32"
+
+
+def _empty_index():
+    return {
+        "keys": np.array([], dtype=str),
+        "starts": np.zeros(0, dtype=np.int32),
+        "ends": np.zeros(0, dtype=np.int32),
+        "hashes": np.array([], dtype=str),
+        "rows": np.zeros(0, dtype=np.int32),
+        "vectors": np.array(_new_file()),
+        "count": np.array(0),
+        "width": np.array(0),
+    }
+
+
+def load_passages(config):
+    """Keys, offsets, hashes and vector rows of the indexed passages, None if there is no index.
+
+    The vectors themselves are in a file of their own, see passage_vectors.
+    """
+    path = passages_path(config)
+    if not path.exists():
+        return None
+    with np.load(path) as data:
+        index = {name: data[name] for name in data.files}
+    if "matrix" in index:
+        index = _convert(config, index)
+    return index
+
+
+def _convert(config, index):
+    # earlier indexes kept the vectors in the npz file, next to the keys
+    matrix = index.pop("matrix").astype(np.float32)
+    converted = _empty_index()
+    converted.update(index)
+    converted.update(
+        rows=np.arange(len(matrix), dtype=np.int32), count=np.array(len(matrix)), width=np.array(matrix.shape[1])
+    )
+    _write_vectors(_vectors_path(config, converted), matrix, 0)
+    save_passages(converted, config)
+    logger.info(f"Moved {len(matrix)} passage vectors to {converted['vectors']}")
+    return converted
+
+
+def save_passages(index, config):
+    # write to a temporary file first, readers in other threads never see half an index
+    path = passages_path(config)
+    tmp = path.with_suffix(".tmp.npz")
+    np.savez(tmp, **index)
+    os.replace(tmp, path)
+
+
+def _write_vectors(path, matrix, start):
+    """Write the rows of matrix to the vector file from row start on."""
+    with open(path, "ab") as f:
+        # rows behind start are left over from an update that did not finish
+        f.truncate(start * matrix.shape[1] * 4)
+        f.write(np.ascontiguousarray(matrix, dtype=np.float32).tobytes())
+
+
+def passage_vectors(config, index):
+    """The normalized passage vectors, the rows of the index point into them.
+
+    The matrix is read once and kept by the diary store, counted against its
+    memory budget.
+    """
+    count, width = int(index["count"]), int(index["width"])
+    if count == 0:
+        return np.zeros((0, width), dtype=np.float32)
+    path = _vectors_path(config, index)
+
+    def load():
+        return np.fromfile(path, dtype=np.float32, count=count * width).reshape(count, width)
+
+    # the cached matrix may have room for more rows than are written yet
+    return get_store(config).cached(config, "passages", (str(index["vectors"]), count), load)[:count]
+
+
+def _grow(matrix, rows, count):
+    # readers only look at their own number of rows, appending behind them is safe
+    if count + len(rows) > len(matrix):
+        bigger = np.empty((max(2 * len(matrix), count + len(rows)), rows.shape[1]), dtype=np.float32)
+        if count:
+            bigger[:count] = matrix[:count]
+        matrix = bigger
+    matrix[count : count + len(rows)] = rows
+    return matrix
+
+
+def indexed_keys(config):
+    index = load_passages(config)
+    return set() if index is None else set(index["keys"].tolist())
+
+
+def plan_passages(config, texts):
+    """Split the entries and find the passages that have no embedding yet.
+
+    Returns the passages of every entry as (start, end, hash) and the texts
+    of the new passages by hash. Passages that did not change, e.g. the
+    earlier messages of today, keep their embedding.
+    """
+    index = load_passages(config)
+    known = set() if index is None else set(index["hashes"].tolist())
+    plan, new = {}, {}
+    for key, text in texts.items():
+        plan[key] = []
+        for start, end in split_passages(text):
+            digest = passage_hash(text[start:end])
+            plan[key].append((start, end, digest))
+            if digest not in known:
+                new[digest] = text[start:end]
+    return plan, new
+
+
+def update_passage_index(config, entries):
+    """Replace the passages of the given entries, {key: [(start, end, hash, vector)]}.
+
+    A vector of None is taken from a stored passage with the same hash. New
+    vectors are appended to the vector file, only the small index of keys
+    and hashes is written again.
+    """
+    index = load_passages(config)
+    if index is None:
+        index = _empty_index()
+    keep = ~np.isin(index["keys"], list(entries))
+    keys = index["keys"][keep].tolist()
+    starts = index["starts"][keep].tolist()
+    ends = index["ends"][keep].tolist()
+    hashes = index["hashes"][keep].tolist()
+    rows = index["rows"][keep].tolist()
+    # passages with the same text share their row
+    known = dict(zip(index["hashes"].tolist(), index["rows"].tolist()))
+    count, width = int(index["count"]), int(index["width"])
+    new = []
+    for key, passages in entries.items():
+        for start, end, digest, vector in passages:
+            row = known.get(digest)
+            if row is None:
+                if vector is None:
+                    continue
+                vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+                row = known[digest] = count + len(new)
+                new.append(vector / max(np.linalg.norm(vector), 1e-12))
+            keys.append(key)
+            starts.append(start)
+            ends.append(end)
+            hashes.append(digest)
+            rows.append(row)
+    updated = {
+        "keys": np.array(keys, dtype=str),
+        "starts": np.array(starts, dtype=np.int32),
+        "ends": np.array(ends, dtype=np.int32),
+        "hashes": np.array(hashes, dtype=str),
+        "rows": np.array(rows, dtype=np.int32),
+        "vectors": index["vectors"],
+        "count": np.array(count + len(new)),
+        "width": np.array(len(new[0]) if new else width),
+    }
+    if new:
+        if count and len(new[0]) != width:
+            raise ValueError(f"passage vectors have {len(new[0])} dimensions, the index {width}")
+        matrix = np.vstack(new)
+        _write_vectors(_vectors_path(config, index), matrix, count)
+        version = str(index["vectors"])
+        get_store(config).update_cached(
+            config, "passages", (version, count), (version, count + len(new)), partial(_grow, rows=matrix, count=count)
+        )
+    if int(updated["count"]) > COMPACT_ROWS and len(np.unique(updated["rows"])) < int(updated["count"]) // 2:
+        updated = _compact(config, updated)
+    else:
+        save_passages(updated, config)
+
+
+def _compact(config, index):
+    """Move the vectors still in use to a new file, the old file is removed."""
+    matrix = passage_vectors(config, index)
+    used = np.unique(index["rows"])
+    remap = np.zeros(len(matrix), dtype=np.int32)
+    remap[used] = np.arange(len(used), dtype=np.int32)
+    compacted = dict(index, rows=remap[index["rows"]], vectors=np.array(_new_file()), count=np.array(len(used)))
+    vectors = matrix[used]
+    _write_vectors(_vectors_path(config, compacted), vectors, 0)
+    save_passages(compacted, config)
+    get_store(config).cached(config, "passages", (str(compacted["vectors"]), len(used)), lambda: vectors)
+    _vectors_path(config, index).unlink(missing_ok=True)
+    logger.info(f"Compacted the passage vectors from {len(matrix)} to {len(used)} rows")
+    return compacted
+
+
+def search_passages(config, query_embedding, n=3):
+    """The best passage of the n best matching entries as (key, start, end, similarity)."""
+    index = load_passages(config)
+    if index is None or len(index["keys"]) == 0:
+        return None
+    query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+    similarity = (passage_vectors(config, index) @ (query / max(np.linalg.norm(query), 1e-12)))[index["rows"]]
+    results, seen = [], set()
+    for i in np.argsort(-similarity):
+        key = index["keys"][i]
+        if key in seen:
+            continue
+        seen.add(key)
+        results.append((str(key), int(index["starts"][i]), int(index["ends"][i]), float(similarity[i])))
+        if len(results) == n:
+            break
+    return results
+
+
+def _best_sentence(passage, query):
+    """Span of the sentence sharing most words with the query, None if no word matches."""
+    words = {w.lower() for w in WORD.findall(query)}
+    best, best_overlap = None, 0
+    for match in SENTENCE.finditer(passage):
+        overlap = len(words & {w.lower() for w in WORD.findall(match.group())})
+        if overlap > best_overlap:
+            best, best_overlap = (match.start(), match.end()), overlap
+    return best
+
+
+def format_passage(text, start, end, query):
+    """Telegram html of a passage with its surrounding context and the match in bold."""
+    passage = text[start:end]
+    span = _best_sentence(passage, query) or (0, len(passage))
+    before = text[max(0, start - CONTEXT_CHARS) : start].lstrip()
+    after = text[end : end + CONTEXT_CHARS].rstrip()
+    parts = []
+    if before:
+        parts.append(("…" if start > CONTEXT_CHARS else "") + html.escape(before))
+    parts.append(
+        html.escape(passage[: span[0]])
+        + "<b>" + html.escape(passage[span[0] : span[1]]) + "</b>"
+        + html.escape(passage[span[1] :])
+    )
+    if after:
+        parts.append(html.escape(after) + ("…" if end + CONTEXT_CHARS < len(text) else ""))
+    return "\n".join(parts)
@@ -1,8 +1,11 @@
 from datetime import datetime
+from pathlib import Path
 
 from fpdf import FPDF
 from fpdf.enums import XPos, YPos
 
+from neighbours import entry_keys
+
 
 class PDF(FPDF):
     def __init__(self):
@@ -120,8 +123,10 @@ def render_toc(pdf, outline):
         )
 
 
-def create_pdf(data, author, start_date=None, end_date=None, table_of_contents_pages=5):
+def create_pdf(data, author, start_date=None, end_date=None, table_of_contents_pages=5, image_dir="./data/images", related=None, progress=None):
 
+    # keys of the neighbour graph, see neighbours.related_keys
+    data = data.assign(key=entry_keys(data["date"]))
     if start_date:
         # convert to datetime: str:22.02.2020
         start_date = datetime.strptime(start_date, "%d.%m.%Y")
@@ -161,13 +166,17 @@ def create_pdf(data, author, start_date=None, end_date=None, table_of_contents_p
 
     pdf.set_col(0)
     pdf.add_page()
+    links = {key: pdf.add_link() for key in data["key"]}
     col_width = 90
     col_height = 5
-    for i, row in data.iterrows():
+    for n, (i, row) in enumerate(data.iterrows()):
+        if progress and n % 50 == 0:
+            progress(f"{n}/{len(data)} entries")
         date = row["date"]
         entry = row["entry"]
         images = row["images"]
         pdf.start_section(f"{date}", level=1)
+        pdf.set_link(links[row["key"]], y=pdf.get_y(), page=pdf.page_no())
         pdf.set_title(f"{date}")
         pdf.set_font("Rokkitt", "B", 16)
         pdf.multi_cell(
@@ -185,10 +194,18 @@ def create_pdf(data, author, start_date=None, end_date=None, table_of_contents_p
         entry = "\n".join(entry) + "\n"
         pdf.multi_cell(col_width, None, entry)
         pdf.ln()
+        if related and related.get(row["key"]):
+            # link to the most similar entries, if they are part of this pdf
+            pdf.set_font("Rokkitt", "", 9)
+            pdf.write(4, "Ähnliche Einträge: ")
+            for key in related[row["key"]]:
+                label = datetime.strptime(key[:10], "%Y-%m-%d").strftime("%d.%m.%Y")
+                pdf.write(4, f"{label}  ", link=links.get(key, ""))
+            pdf.ln(6)
         if len(images) > 0:
             for image in images:
                 pdf.image(
-                    "./data/images/" + image,
+                    str(Path(image_dir) / image),
                     w=col_width - 5,
                 )
 
@@ -197,5 +214,5 @@ def create_pdf(data, author, start_date=None, end_date=None, table_of_contents_p
     dates = f"{first_date}-{end_date}"
     file = f'{dates}-{author.replace(" ", "_")}.pdf'.lower()
     filepath = file
-    pdf.output(filepath, "F")
+    pdf.output(filepath)
     return filepath
@@ -0,0 +1,187 @@
+import asyncio
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+import tracemalloc
+from functools import partial, wraps
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+# names of the handlers and jobs that can be profiled
+profilable = set()
+# armed profiles by handler or job name
+_armed = {}
+_capture = contextvars.ContextVar("capture", default=None)
+_running = threading.Lock()
+
+
+class Capture:
+    """Profiles of one handler run, its worker threads and the jobs it started."""
+
+    def __init__(self, name, chat_id, top, memory):
+        self.name = name
+        self.chat_id = chat_id
+        self.top = top
+        self.memory = memory
+        self.profiles = []
+        self.tasks = []
+        self._lock = threading.Lock()
+
+    def track(self, task):
+        """Keep profiling until a background task started by the run is done."""
+        self.tasks.append(task)
+
+    async def profile_steps(self, coro):
+        """Profile a coroutine only while it runs, not while it waits in an await.
+
+        The event loop, its idle wait and other updates run between the steps,
+        so they stay out of the table.
+        """
+        return await _Steps(coro, self.profiles[0])
+
+    def run_profiled(self, func, *args, **kwargs):
+        # cProfile only sees its own thread, so every worker thread gets one
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        return profile.runcall(func, *args, **kwargs)
+
+
+class _Steps:
+    def __init__(self, coro, profile):
+        self.coro = coro
+        self.profile = profile
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            self.profile.enable()
+            try:
+                future = self.coro.send(value) if error is None else self.coro.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.profile.disable()
+            try:
+                value, error = (yield future), None
+            except GeneratorExit:
+                self.coro.close()
+                raise
+            except BaseException as e:
+                value, error = None, e
+
+
+def arm(name, chat_id, top=30, memory=False):
+    """Profile the next run of a handler or job, the result goes to chat_id."""
+    _armed[name] = Capture(name, chat_id, top, memory)
+
+
+def current():
+    return _capture.get()
+
+
+async def to_thread(func, *args, **kwargs):
+    """asyncio.to_thread, the thread is profiled if it belongs to a profiled run."""
+    capture = _capture.get()
+    if capture is not None:
+        func = partial(capture.run_profiled, func)
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+
+def _chat_id(args):
+    # handlers get (update, context), jobs only the context
+    if len(args) > 1:
+        chat = getattr(args[0], "effective_chat", None)
+        return chat.id if chat else None
+    job = getattr(args[-1], "job", None)
+    return job.chat_id if job else None
+
+
+def profiled(name, callback):
+    """Wrap a handler or job callback so it can be armed for profiling.
+
+    Only a run in the chat that armed the profile is profiled. The table
+    holds the time the callback, its jobs and worker threads spend running.
+    Time spent waiting in an await, e.g. for Telegram or OpenAI, only counts
+    in the wall time. When nothing is armed this costs one dict lookup per
+    call.
+    """
+    profilable.add(name)
+
+    @wraps(callback)
+    async def wrapper(*args, **kwargs):
+        capture = _armed.get(name)
+        if capture is None or _chat_id(args) != capture.chat_id or not _running.acquire(blocking=False):
+            return await callback(*args, **kwargs)
+        capture = _armed.pop(name)
+        try:
+            await _run(capture, callback, args, kwargs)
+        finally:
+            _running.release()
+
+    return wrapper
+
+
+async def _run(capture, callback, args, kwargs):
+    # handlers get (update, context), jobs only the context
+    context = args[-1]
+    token = _capture.set(capture)
+    if capture.memory:
+        tracemalloc.start()
+    capture.profiles.append(cProfile.Profile())
+    start = time.perf_counter()
+    try:
+        await capture.profile_steps(callback(*args, **kwargs))
+        # the tasks are tracked while the callback runs, e.g. by the job manager
+        await asyncio.gather(*capture.tasks, return_exceptions=True)
+    finally:
+        _capture.reset(token)
+        elapsed = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot() if capture.memory else None
+        if capture.memory:
+            tracemalloc.stop()
+        await send_profile(capture, elapsed, snapshot, context.bot)
+
+
+def format_profile(capture, elapsed, snapshot):
+    """Top cumulative time table and the path of the raw stats."""
+    stats = pstats.Stats(capture.profiles[0])
+    for profile in capture.profiles[1:]:
+        stats.add(profile)
+    path = tempfile.NamedTemporaryFile(prefix=f"{capture.name}_", suffix=".pstats", delete=False).name
+    stats.dump_stats(path)
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.strip_dirs().sort_stats("cumulative").print_stats(capture.top)
+    # drop the header lines of pstats
+    table = stream.getvalue().split("\n\n", 2)[-1].strip()
+    text = (
+        f"Profile of {capture.name}: {elapsed:.2f} s wall time, {stats.total_tt:.2f} s running, "
+        f"{len(capture.profiles) - 1} worker thread(s)\n\n{table}"
+    )
+    if snapshot is not None:
+        lines = [str(s) for s in snapshot.statistics("lineno")[: capture.top // 3]]
+        text += "\n\nTop allocations:\n" + "\n".join(lines)
+    return text, path
+
+
+async def send_profile(capture, elapsed, snapshot, bot):
+    text, path = await asyncio.to_thread(format_profile, capture, elapsed, snapshot)
+    logger.info(f"Profiled {capture.name} in {elapsed:.2f} s")
+    for i in range(0, len(text), 4000):
+        await bot.send_message(chat_id=capture.chat_id, text=text[i : i + 4000])
+    try:
+        with open(path, "rb") as f:
+            await bot.send_document(chat_id=capture.chat_id, document=f)
+    finally:
+        os.remove(path)
@@ -1,12 +1,12 @@
 import logging
 from datetime import datetime
-from pathlib import Path
 
 import pandas as pd
 import telegram
 from telegram import Update
 
 from diary import get_diary
+from sender import send_photos
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -21,15 +21,20 @@ async def send_day_before_and_after(entry, context, config):
     # entry is a Series object convert to pandas DataFrame
     if isinstance(entry, pd.Series):
         entry = pd.DataFrame(entry).T
-    entry_date = pd.to_datetime(entry["date"].values[0]).strftime("%d_%m_%Ys_1")
-    daybefore, dayafter = get_closest_entries(entry["date"].values[0], diary)
-    msg = (
+    msg = closest_entries_message(entry["date"].values[0], diary)
+    await context.bot.send_message(chat_id=config.get("chat_id"), text=msg)
+
+
+def closest_entries_message(date, diary):
+    """Links to the similar entries and the entries before and after date."""
+    entry_date = pd.to_datetime(date).strftime("%d_%m_%Ys_1")
+    daybefore, dayafter = get_closest_entries(date, diary)
+    return (
         f"Here are the closest entries:\n"
         f"Similar entry for today: /{entry_date}\n"
         f"Before: /{daybefore}\n"
         f"After: /{dayafter}"
     )
-    await context.bot.send_message(chat_id=config.get("chat_id"), text=msg)
 
 
 def get_entry_by_date(date, config, year=False):
@@ -90,9 +95,7 @@ async def search_by_date(
                 await update.message.reply_text(text=text[i: i + MAX_LENGTH])
             images = entry["images"].values[0]
             if len(images) > 0:
-                for image in images:
-                    with open(Path(config.get("image_dir")) / Path(image), "rb") as f:
-                        await update.message.reply_photo(photo=f)
+                await send_photos(context.bot, update.message.chat_id, images, config)
             await send_day_before_and_after(entry, context, config)
     else:
 
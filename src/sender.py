@@ -0,0 +1,86 @@
+import json
+import logging
+from contextlib import ExitStack
+from pathlib import Path
+
+from telegram import InputMediaPhoto
+from telegram.error import BadRequest
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+# telegram accepts at most 10 photos per media group
+MEDIA_GROUP_SIZE = 10
+
+_file_ids = {}
+
+
+def _file_id_path(config):
+    return Path(config.get("image_dir")) / "file_ids.json"
+
+
+def get_file_ids(config):
+    """Get the known telegram file_ids of the stored images."""
+    path = _file_id_path(config)
+    if path not in _file_ids:
+        _file_ids[path] = json.loads(path.read_text()) if path.exists() else {}
+    return _file_ids[path]
+
+
+def remember_file_id(config, image, file_id):
+    file_ids = get_file_ids(config)
+    if file_ids.get(image) != file_id:
+        file_ids[image] = file_id
+        path = _file_id_path(config)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(file_ids))
+
+
+def file_id_for(image, config):
+    """Photos are saved as <file_id>.jpeg, so the name is the file_id unless a newer one is known."""
+    return get_file_ids(config).get(image, Path(image).stem)
+
+
+async def send_photos(bot, chat_id, images, config):
+    """Sends stored images by file_id, several at once as media groups.
+
+    Images are uploaded from disk only if telegram rejects the file_id, the
+    file_id of the upload is remembered for the next time.
+    """
+    for i in range(0, len(images), MEDIA_GROUP_SIZE):
+        chunk = images[i : i + MEDIA_GROUP_SIZE]
+        if len(chunk) == 1:
+            await _send_photo(bot, chat_id, chunk[0], config)
+        else:
+            await _send_media_group(bot, chat_id, chunk, config)
+
+
+async def _send_photo(bot, chat_id, image, config):
+    try:
+        await bot.send_photo(chat_id=chat_id, photo=file_id_for(image, config))
+        return
+    except BadRequest as e:
+        logger.info(f"file_id of {image} rejected, uploading it: {e}")
+    with open(Path(config.get("image_dir")) / Path(image), "rb") as f:
+        message = await bot.send_photo(chat_id=chat_id, photo=f)
+    remember_file_id(config, image, message.photo[-1].file_id)
+
+
+async def _send_media_group(bot, chat_id, images, config):
+    try:
+        media = [InputMediaPhoto(file_id_for(image, config)) for image in images]
+        await bot.send_media_group(chat_id=chat_id, media=media)
+        return
+    except BadRequest as e:
+        logger.info(f"file_ids of {images} rejected, uploading them: {e}")
+    with ExitStack() as stack:
+        media = [
+            InputMediaPhoto(stack.enter_context(open(Path(config.get("image_dir")) / Path(image), "rb")))
+            for image in images
+        ]
+        messages = await bot.send_media_group(chat_id=chat_id, media=media)
+    for image, message in zip(images, messages):
+        remember_file_id(config, image, message.photo[-1].file_id)
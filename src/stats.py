@@ -88,3 +88,32 @@ def make_stats(diary: pd.DataFrame):
 
     stats = f"Stats:\n\nNumber of entries: {entries}\nNumber of words: {word_count}\nMean words per entry: {mean_words}"
     return stats, entries_per_weekday, entries_per_month
+
+
+def make_mood_chart(mood: pd.DataFrame, window="30D"):
+    """Plot the mood of every entry and its rolling average over the window."""
+    mood = mood.dropna(subset=["mood"]).sort_values("date").set_index("date")
+    mood["average"] = mood["mood"].rolling(window).mean()
+    fig = px.scatter(
+        mood.reset_index(),
+        x="date",
+        y="mood",
+        title=f"Mood per entry and {window} rolling average",
+        color="mood",
+        color_continuous_scale=px.colors.diverging.RdYlGn,
+        range_color=[-1, 1],
+        opacity=0.5,
+        width=800,
+        height=400,
+    )
+    fig.add_scatter(
+        x=mood.index, y=mood["average"], mode="lines", name="average", line_color="black"
+    )
+    mood_chart = "/tmp/mood.png"
+    fig.write_image(mood_chart, format="png", engine="kaleido")
+
+    text = (
+        f"Mood:\n\nScored entries: {len(mood)}\n"
+        f"Mean mood: {round(mood['mood'].mean(), 2)} (from -1 to 1)"
+    )
+    return text, mood_chart
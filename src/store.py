@@ -0,0 +1,301 @@
+import ast
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+
+def empty_diary():
+    return pd.DataFrame(
+        {
+            "date": pd.Series(dtype="datetime64[ns]"),
+            "entry": pd.Series(dtype=str),
+            "images": pd.Series(dtype=object),
+        }
+    )
+
+
+def load_embeddings(path, n):
+    """Load the stored embeddings as (1, d) float32 rows, None where missing."""
+    embeddings = np.load(path, allow_pickle=True)
+    rows = []
+    for embedding in embeddings.tolist():
+        if embedding is None or np.size(embedding) <= 1:
+            rows.append(None)
+        else:
+            rows.append(np.asarray(embedding, dtype=np.float32).reshape(1, -1))
+    if len(rows) != n:
+        logger.warning(f"{path} has {len(rows)} embeddings for {n} entries")
+        rows = (rows + [None] * n)[:n]
+    return rows
+
+
+def partitions_dir(config):
+    """Directory of the month partitions, e.g. data/tagebuch for data/tagebuch.csv."""
+    return Path(config.get("diary_csv")).with_suffix("")
+
+
+def manifest_path(config):
+    return partitions_dir(config) / "manifest.json"
+
+
+def read_manifest(config):
+    """Entries and version of every month partition, {"2022-12": {"entries": 3, "version": 1}}."""
+    path = manifest_path(config)
+    return json.loads(path.read_text())["partitions"] if path.exists() else {}
+
+
+def write_manifest(manifest, config):
+    # write to a temporary file first, readers never see half a manifest
+    path = manifest_path(config)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"partitions": manifest}, indent=1, sort_keys=True))
+    os.replace(tmp, path)
+
+
+def read_csv(path, embedding_file=None):
+    """Read entries from a csv file and their embeddings from a npy file."""
+    df = pd.read_csv(path)
+    df["images"] = df["images"].apply(ast.literal_eval)
+    df["date"] = pd.to_datetime(df["date"])
+    df["entry"] = df["entry"].astype(str)
+    if embedding_file is not None and Path(embedding_file).exists():
+        df["embedding"] = load_embeddings(embedding_file, len(df))
+    return df
+
+
+def read_partition(config, month):
+    """Read the entries of one month with their embeddings."""
+    directory = partitions_dir(config)
+    df = read_csv(directory / f"{month}.csv", directory / f"{month}.npy")
+    if "embedding" not in df.columns:
+        df["embedding"] = None
+    return df
+
+
+def write_partition(df, config, month):
+    directory = partitions_dir(config)
+    embedding = np.empty(len(df), dtype=object)
+    if "embedding" in df.columns:
+        embedding[:] = [
+            e if isinstance(e, (np.ndarray, list)) else None
+            for e in df["embedding"].values
+        ]
+        df = df.drop(columns=["embedding"])
+    # np.save appends .npy to the name of the temporary file
+    np.save(directory / f"{month}.tmp", embedding)
+    os.replace(directory / f"{month}.tmp.npy", directory / f"{month}.npy")
+    df.to_csv(directory / f"{month}.tmp", index=False)
+    os.replace(directory / f"{month}.tmp", directory / f"{month}.csv")
+
+
+def write_partitions(df, config, manifest, months=None):
+    """Write the month partitions of a diary and update the manifest in place.
+
+    Only the given months are written, all of them if months is None.
+    Returns the written partitions by month, None for months without entries,
+    whose partition is removed.
+    """
+    directory = partitions_dir(config)
+    directory.mkdir(parents=True, exist_ok=True)
+    Path(config.get("image_dir")).mkdir(parents=True, exist_ok=True)
+    df = df.reset_index(drop=True)
+    month_of = df["date"].dt.strftime("%Y-%m")
+    if months is None:
+        months = set(month_of) | set(manifest)
+    written = {}
+    if not months:
+        return written
+    for month in sorted(months):
+        part = df[month_of == month].reset_index(drop=True)
+        if len(part) == 0:
+            for suffix in (".csv", ".npy"):
+                (directory / f"{month}{suffix}").unlink(missing_ok=True)
+            manifest.pop(month, None)
+            written[month] = None
+            continue
+        write_partition(part, config, month)
+        version = manifest.get(month, {}).get("version", 0) + 1
+        manifest[month] = {"entries": len(part), "version": version}
+        written[month] = part
+    write_manifest(manifest, config)
+    return written
+
+
+def migrate(config):
+    """Split a diary stored in one csv file into month partitions.
+
+    The old files are kept with a .migrated suffix. Returns False if there
+    is nothing to migrate.
+    """
+    csv = Path(config.get("diary_csv"))
+    if manifest_path(config).exists() or not csv.exists():
+        return False
+    embedding_file = Path(config.get("embedding_file"))
+    df = read_csv(csv, embedding_file)
+    manifest = {}
+    write_partitions(df, config, manifest)
+    for path in (csv, embedding_file):
+        if path.exists():
+            os.replace(path, path.with_name(path.name + ".migrated"))
+    logger.info(f"Migrated {len(df)} entries of {csv} into {len(manifest)} month partitions")
+    return True
+
+
+def diary_size(df):
+    """Approximate memory used by a loaded diary in bytes."""
+    size = int(df.drop(columns=["embedding"], errors="ignore").memory_usage(deep=True).sum())
+    if "embedding" in df.columns:
+        size += sum(e.nbytes for e in df["embedding"].values if isinstance(e, np.ndarray))
+    return size
+
+
+def _mtime(path):
+    path = Path(path)
+    return path.stat().st_mtime_ns if path.exists() else None
+
+
+def _months(manifest, start=None, end=None):
+    """Months of the partitions that can hold entries from start to end."""
+    return [
+        month
+        for month in sorted(manifest)
+        if (start is None or month >= start.strftime("%Y-%m"))
+        and (end is None or month <= end.strftime("%Y-%m"))
+    ]
+
+
+class DiaryStore:
+    """Keeps recently used month partitions of the diaries in memory within a memory budget.
+
+    Partitions are read on first use and the least recently used ones are
+    evicted when the budget is exceeded. A partition changed on disk by
+    someone else is read again, the manifest holds a version for every month.
+    """
+
+    def __init__(self, budget_mb=512):
+        self.budget = budget_mb * 1024 * 1024
+        self._partitions = OrderedDict()
+        self._manifests = {}
+        # the write queue and the embedding worker use the store from threads
+        self._lock = threading.RLock()
+
+    def manifest(self, config):
+        key = config.get("diary_csv")
+        with self._lock:
+            if not manifest_path(config).exists():
+                migrate(config)
+            mtime = _mtime(manifest_path(config))
+            cached = self._manifests.get(key)
+            if cached is None or cached[0] != mtime:
+                self._manifests[key] = (mtime, read_manifest(config))
+            return self._manifests[key][1]
+
+    def get(self, config, start=None, end=None):
+        """Get the diary, or only its entries from start to end (datetimes, inclusive).
+
+        Only the partitions of the months in the range are read.
+        """
+        with self._lock:
+            manifest = self.manifest(config)
+            frames = [
+                self._partition(config, month, manifest[month]["version"])
+                for month in _months(manifest, start, end)
+            ]
+        if not frames:
+            return empty_diary()
+        df = pd.concat(frames, ignore_index=True)
+        if start is not None:
+            df = df[df["date"] >= start]
+        if end is not None:
+            df = df[df["date"] <= end]
+        return df.reset_index(drop=True)
+
+    def _partition(self, config, month, version):
+        key = (config.get("diary_csv"), month)
+        cached = self._partitions.get(key)
+        if cached is None or cached[0] != version:
+            logger.debug(f"Loading diary {key[0]} {month}")
+            df = read_partition(config, month)
+            self._put(key, version, df)
+            return df
+        self._partitions.move_to_end(key)
+        return cached[1]
+
+    def save(self, df, config, months=None):
+        """Write a diary, only the partitions of the given months if known."""
+        key = config.get("diary_csv")
+        with self._lock:
+            manifest = dict(self.manifest(config))
+            written = write_partitions(df, config, manifest, months)
+            self._manifests[key] = (_mtime(manifest_path(config)), manifest)
+            for month, part in written.items():
+                if part is None:
+                    self._partitions.pop((key, month), None)
+                else:
+                    self._put((key, month), manifest[month]["version"], part)
+
+    def cached(self, config, name, version, load):
+        """Keep other data of a diary in memory within the budget, e.g. the passage vectors.
+
+        load() reads the array if the cached one is evicted or has another version.
+        """
+        key = (config.get("diary_csv"), name)
+        with self._lock:
+            cached = self._partitions.get(key)
+            if cached is not None and cached[0] == version:
+                self._partitions.move_to_end(key)
+                return cached[1]
+            value = load()
+            self._put(key, version, value, value.nbytes)
+            return value
+
+    def update_cached(self, config, name, version, new_version, update):
+        """Change a cached array in place of reading it again, if it is cached with version."""
+        key = (config.get("diary_csv"), name)
+        with self._lock:
+            cached = self._partitions.get(key)
+            if cached is not None and cached[0] == version:
+                value = update(cached[1])
+                self._put(key, new_version, value, value.nbytes)
+
+    def _put(self, key, version, value, size=None):
+        self._partitions[key] = (version, value, diary_size(value) if size is None else size)
+        self._partitions.move_to_end(key)
+        self._evict()
+
+    def _evict(self):
+        used = sum(size for _, _, size in self._partitions.values())
+        # always keep the partition that was just used
+        while used > self.budget and len(self._partitions) > 1:
+            key, (_, _, size) = self._partitions.popitem(last=False)
+            used -= size
+            logger.info(f"Evicted diary {key[0]} {key[1]} ({size / 1024 / 1024:.1f} MB)")
+
+    def evict(self, config):
+        key = config.get("diary_csv")
+        with self._lock:
+            self._manifests.pop(key, None)
+            for cached in [k for k in self._partitions if k[0] == key]:
+                del self._partitions[cached]
+
+
+_store = None
+
+
+def get_store(config):
+    global _store
+    if _store is None:
+        _store = DiaryStore(config.get("diary_cache_mb", 512))
+    return _store
@@ -0,0 +1,98 @@
+import logging
+import math
+import re
+
+import numpy as np
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+TIME_MARKER = re.compile(r"^--\s*\d{1,2}:\d{2}\s*--$")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+# sentences with fewer words carry too little information to be kept
+MIN_WORDS = 3
+DAMPING = 0.85
+
+
+def estimate_tokens(text):
+    """Rough number of tokens of a text, about four characters per token."""
+    return math.ceil(len(text) / 4)
+
+
+def split_sentences(text):
+    """Split an entry into sentences, time markers and short lines are dropped."""
+    sentences = []
+    for sentence in SENTENCE_END.split(str(text)):
+        sentence = sentence.strip()
+        if TIME_MARKER.match(sentence) or len(sentence.split()) < MIN_WORDS:
+            continue
+        sentences.append(sentence)
+    return sentences
+
+
+def rank_sentences(sentences, iterations=50, tol=1e-6):
+    """Centrality of every sentence, TextRank over tf-idf cosine similarity.
+
+    The similarity matrix is never built, every step multiplies with the
+    sparse tf-idf matrix twice, so memory grows with the number of words
+    instead of the square of the number of sentences.
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    n = len(sentences)
+    if n < 2:
+        return np.ones(n)
+    try:
+        vectors = TfidfVectorizer().fit_transform(sentences)
+    except ValueError:
+        # only stop words or numbers
+        return np.ones(n)
+    # similarity is vectors @ vectors.T without its diagonal, a sentence is not similar to itself
+    self_similarity = np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel()
+
+    def similar(x):
+        return vectors @ (vectors.T @ x) - self_similarity * x
+
+    weights = similar(np.ones(n))
+    linked = weights > 1e-9
+    scores = np.full(n, 1 / n)
+    for _ in range(iterations):
+        # sentences similar to nothing link to every sentence
+        spread = similar(np.where(linked, scores / np.where(linked, weights, 1), 0))
+        updated = (1 - DAMPING) / n + DAMPING * (spread + scores[~linked].sum() / n)
+        if np.abs(updated - scores).sum() < tol:
+            break
+        scores = updated
+    return updated
+
+
+def summarize_entries(data, token_budget):
+    """Keep the most central sentences of all entries within the token budget.
+
+    Sentences keep their order, entries without a kept sentence are dropped.
+    """
+    sentences = [(i, s) for i, entry in enumerate(data["entry"]) for s in split_sentences(entry)]
+    scores = rank_sentences([s for _, s in sentences])
+    keep = set()
+    used = 0
+    for index in np.argsort(-scores):
+        tokens = estimate_tokens(sentences[index][1])
+        if used + tokens > token_budget:
+            continue
+        keep.add(index)
+        used += tokens
+    kept = [[] for _ in range(len(data))]
+    for index in sorted(keep):
+        entry, sentence = sentences[index]
+        kept[entry].append(sentence)
+    summary = data.copy()
+    summary["entry"] = ["\n".join(s) for s in kept]
+    summary = summary[summary["entry"] != ""]
+    logger.info(
+        f"Kept {len(keep)} of {len(sentences)} sentences from {len(data)} entries, "
+        f"about {used} tokens"
+    )
+    return summary
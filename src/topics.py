@@ -0,0 +1,153 @@
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+from neighbours import embedding_matrix
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+# entries shown per topic
+REPRESENTATIVES = 3
+# the model is fitted again once the diary has grown by this factor
+REFIT_GROWTH = 1.5
+
+
+def topics_path(config):
+    return Path(config.get("embedding_file")).with_name("topics.npz")
+
+
+def load_topics(config):
+    path = topics_path(config)
+    if not path.exists():
+        return None
+    data = np.load(path)
+    return {name: data[name] for name in data.files}
+
+
+def save_topics(model, config):
+    # write to a temporary file first, readers in other threads never see half a model
+    path = topics_path(config)
+    tmp = path.with_suffix(".tmp.npz")
+    np.savez(tmp, **model)
+    os.replace(tmp, path)
+
+
+def fit_topics(keys, matrix, n_topics):
+    """Cluster all embeddings with mini-batch k-means."""
+    from sklearn.cluster import MiniBatchKMeans
+
+    kmeans = MiniBatchKMeans(
+        n_clusters=n_topics, batch_size=256, n_init=3, random_state=0
+    ).fit(matrix)
+    return {
+        "keys": np.array(keys, dtype=str),
+        "labels": kmeans.labels_.astype(np.int32),
+        "centroids": kmeans.cluster_centers_.astype(np.float32),
+        "counts": np.bincount(kmeans.labels_, minlength=n_topics).astype(np.int64),
+        "fitted_on": np.array(len(keys)),
+    }
+
+
+def _nearest(centroids, vectors):
+    distances = (
+        (vectors**2).sum(axis=1, keepdims=True)
+        - 2 * vectors @ centroids.T
+        + (centroids**2).sum(axis=1)
+    )
+    return distances.argmin(axis=1)
+
+
+def partial_fit_topics(model, keys, matrix, changed):
+    """Assign new and changed entries and move the centroids towards new entries.
+
+    New entries update their centroid with the per-centroid learning rate of
+    mini-batch k-means, entries that changed only get a new label.
+    """
+    labels = dict(zip(model["keys"].tolist(), model["labels"].tolist()))
+    centroids = model["centroids"].copy()
+    counts = model["counts"].copy()
+    position = {key: i for i, key in enumerate(keys)}
+    for key in keys:
+        if key not in labels:
+            x = matrix[position[key]]
+            label = int(_nearest(centroids, x[None, :])[0])
+            counts[label] += 1
+            centroids[label] += (x - centroids[label]) / counts[label]
+            labels[key] = label
+    changed = [key for key in changed if key in position]
+    if changed:
+        new_labels = _nearest(centroids, matrix[[position[key] for key in changed]])
+        labels.update(zip(changed, new_labels.tolist()))
+    return {
+        "keys": np.array(keys, dtype=str),
+        "labels": np.array([labels[key] for key in keys], dtype=np.int32),
+        "centroids": centroids,
+        "counts": counts,
+        "fitted_on": model["fitted_on"],
+    }
+
+
+def _representatives(model, matrix):
+    """Keys of the entries closest to every centroid."""
+    representatives = np.full((len(model["centroids"]), REPRESENTATIVES), "", dtype=object)
+    for label, centroid in enumerate(model["centroids"]):
+        members = np.flatnonzero(model["labels"] == label)
+        distances = ((matrix[members] - centroid) ** 2).sum(axis=1)
+        closest = members[np.argsort(distances)[:REPRESENTATIVES]]
+        representatives[label, : len(closest)] = model["keys"][closest]
+    return representatives.astype(str)
+
+
+def update_topics(diary, config, changed=()):
+    """Bring the stored topic model up to date with the diary."""
+    keys, matrix = embedding_matrix(diary)
+    n_topics = config.get("topics", 8)
+    if len(keys) < n_topics:
+        return None
+    model = load_topics(config)
+    if (
+        model is None
+        or len(model["centroids"]) != n_topics
+        or model["centroids"].shape[1] != matrix.shape[1]
+        or len(keys) > model["fitted_on"] * REFIT_GROWTH
+    ):
+        logger.info(f"Fitting {n_topics} topics on {len(keys)} entries")
+        model = fit_topics(keys, matrix, n_topics)
+    else:
+        model = partial_fit_topics(model, keys, matrix, changed)
+    model["representatives"] = _representatives(model, matrix)
+    save_topics(model, config)
+    return model
+
+
+def describe_topics(model, diary, months=6):
+    """Text with the representative entries and entries per month of every topic."""
+    entries = dict(zip(model["keys"].tolist(), model["labels"].tolist()))
+    texts = {}
+    for date, entry in zip(diary["date"], diary["entry"]):
+        texts.setdefault(date.strftime("%Y-%m-%d"), entry)
+    sizes = np.bincount(model["labels"], minlength=len(model["centroids"]))
+    blocks = []
+    for label in np.argsort(-sizes):
+        if sizes[label] == 0:
+            continue
+        lines = [f"Topic {label + 1} ({sizes[label]} entries)"]
+        for key in model["representatives"][label]:
+            if key:
+                day = key[:10]
+                text = " ".join(texts.get(day, "").split())[:80]
+                lines.append(f"/{day[8:10]}_{day[5:7]}_{day[:4]} {text}")
+        per_month = {}
+        for key, entry_label in entries.items():
+            if entry_label == label:
+                per_month[key[:7]] = per_month.get(key[:7], 0) + 1
+        recent = sorted(per_month.items())[-months:]
+        lines.append("Per month: " + ", ".join(f"{month}: {count}" for month, count in recent))
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+_queues = {}
+
+
+class WriteQueue:
+    """Serializes the writes to one diary and coalesces bursts of updates.
+
+    Every update submitted within `window` seconds of the first one is handed
+    to `flush` as one batch, so a burst of messages or an album of photos
+    results in a single load, embedding call and save of the diary.
+    """
+
+    def __init__(self, flush, window=1.0, max_batch=50):
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = asyncio.Queue()
+        self._worker = None
+
+    async def submit(self, update):
+        """Queues an update and waits until it has been written to disk."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((update, future))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            updates = [update for update, _ in batch]
+            logger.info(f"Writing {len(updates)} coalesced update(s)")
+            try:
+                # pandas and the OpenAI client block, keep them off the event loop
+                await asyncio.to_thread(self.flush, updates)
+            except Exception as e:
+                logger.error(f"Writing updates failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+
+def get_write_queue(key, flush, window=1.0):
+    """Returns the write queue for the diary identified by key."""
+    if key not in _queues:
+        _queues[key] = WriteQueue(flush, window=window)
+    return _queues[key]
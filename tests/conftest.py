@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+
+import pytest
+from pyhocon import ConfigFactory
+
+# the bot runs from src/ and imports its modules by name
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+
+@pytest.fixture
+def config(tmp_path):
+    return ConfigFactory.from_dict(
+        {
+            "diary_csv": str(tmp_path / "tagebuch.csv"),
+            "embedding_file": str(tmp_path / "embeddings.npy"),
+            "image_dir": str(tmp_path / "images"),
+            "data_dir": str(tmp_path),
+        }
+    )
@@ -0,0 +1,161 @@
+import asyncio
+
+import numpy as np
+
+import embed_queue
+from embed_queue import EmbeddingWorker, complete, enqueue, has_jobs, passages_only, queue_path, retry_later, take
+
+
+def test_take_returns_the_queued_versions(config):
+    enqueue(config, ["2023-01-01", "2023-01-02"])
+    enqueue(config, ["2023-01-02"])
+
+    due, wait = take(config, batch_size=10)
+
+    assert due == {"2023-01-01": 1, "2023-01-02": 2}
+    assert wait is None
+
+
+def test_take_respects_the_batch_size(config):
+    enqueue(config, ["a", "b", "c"])
+
+    due, _ = take(config, batch_size=2)
+
+    assert len(due) == 2
+
+
+def test_complete_keeps_entries_queued_again_meanwhile(config):
+    enqueue(config, ["a", "b"])
+    taken, _ = take(config, batch_size=10)
+    # b changes while the batch is embedded
+    enqueue(config, ["b"])
+
+    complete(config, taken)
+
+    assert take(config, batch_size=10)[0] == {"b": 2}
+
+
+def test_complete_removes_the_empty_queue_file(config):
+    enqueue(config, ["a"])
+    assert has_jobs(config)
+
+    complete(config, take(config, batch_size=10)[0])
+
+    assert not queue_path(config).exists()
+    assert not has_jobs(config)
+
+
+def test_retry_later_backs_off(config):
+    enqueue(config, ["a"])
+    taken, _ = take(config, batch_size=10)
+
+    retry_later(config, taken, base=5)
+
+    due, wait = take(config, batch_size=10)
+    assert due == {}
+    assert 0 < wait <= 5
+    # queueing the entry again makes it due at once
+    enqueue(config, ["a"])
+    assert take(config, batch_size=10)[0] == {"a": 2}
+
+
+def test_retry_later_parks_jobs_after_max_attempts(config):
+    enqueue(config, ["a", "b"])
+    taken, _ = take(config, batch_size=10)
+
+    assert retry_later(config, {"a": 1}, base=0, max_attempts=2) == []
+    assert retry_later(config, {"a": 1}, base=0, max_attempts=2) == ["a"]
+
+    assert take(config, batch_size=10)[0] == {"b": 1}
+    complete(config, {"b": 1})
+    # the failed job stays on record, but there is nothing to do
+    assert queue_path(config).exists()
+    assert not has_jobs(config)
+    assert take(config, batch_size=10) == ({}, None)
+    # a changed entry gets another chance
+    enqueue(config, ["a"])
+    assert take(config, batch_size=10)[0] == {"a": 2}
+
+
+class Refused(Exception):
+    status_code = 400
+
+
+def test_worker_embeds_the_batch_mates_of_a_refused_entry(config, monkeypatch):
+    texts = {"a": "first", "b": "far too long", "c": "third"}
+    requests = []
+
+    def get_embeddings(inputs):
+        requests.append(inputs)
+        if "far too long" in inputs:
+            raise Refused("maximum context length")
+        return [np.ones((1, 2), dtype=np.float32) for _ in inputs]
+
+    monkeypatch.setattr(embed_queue, "pending_texts", lambda config, keys: {key: texts[key] for key in keys})
+    monkeypatch.setattr(embed_queue, "plan_passages", lambda config, texts: ({key: [] for key in texts}, {}))
+    monkeypatch.setattr(embed_queue, "get_embeddings", get_embeddings)
+    written = []
+
+    async def write(update):
+        written.extend(update["embeddings"])
+
+    enqueue(config, list(texts))
+    worker = EmbeddingWorker(config, write)
+    asyncio.run(worker._process(take(config, batch_size=10)[0]))
+
+    assert sorted(written) == ["a", "c"]
+    assert len(requests) == 4
+    due, wait = take(config, batch_size=10)
+    assert due == {} and wait > 0
+
+
+def test_worker_retries_the_whole_batch_on_other_errors(config, monkeypatch):
+    def get_embeddings(inputs):
+        raise ConnectionError("offline")
+
+    monkeypatch.setattr(embed_queue, "pending_texts", lambda config, keys: {key: key for key in keys})
+    monkeypatch.setattr(embed_queue, "plan_passages", lambda config, texts: ({key: [] for key in texts}, {}))
+    monkeypatch.setattr(embed_queue, "get_embeddings", get_embeddings)
+    enqueue(config, ["a", "b"])
+
+    asyncio.run(EmbeddingWorker(config, None)._process(take(config, batch_size=10)[0]))
+
+    assert take(config, batch_size=10)[0] == {}
+    assert has_jobs(config)
+
+
+def test_passages_only_jobs_become_whole_entry_jobs(config):
+    enqueue(config, ["a", "b"], passages_only=True)
+    enqueue(config, ["c"])
+    enqueue(config, ["a"])
+    enqueue(config, ["c"], passages_only=True)
+
+    assert passages_only(config, ["a", "b", "c"]) == {"b"}
+
+
+def test_worker_embeds_only_the_passages_of_current_entries(config, monkeypatch):
+    texts = {"a": "new entry", "b": "entry with a current embedding"}
+    plan = {"a": [(0, 9, "ha")], "b": [(0, 30, "hb")]}
+    requests = []
+
+    def get_embeddings(inputs):
+        requests.append(inputs)
+        return [np.ones((1, 2), dtype=np.float32) for _ in inputs]
+
+    monkeypatch.setattr(embed_queue, "pending_texts", lambda config, keys: {key: texts[key] for key in keys})
+    monkeypatch.setattr(embed_queue, "plan_passages", lambda config, texts: (plan, {"ha": texts["a"], "hb": texts["b"]}))
+    monkeypatch.setattr(embed_queue, "get_embeddings", get_embeddings)
+    updates = []
+
+    async def write(update):
+        updates.append(update)
+
+    enqueue(config, ["a"])
+    enqueue(config, ["b"], passages_only=True)
+    asyncio.run(EmbeddingWorker(config, write)._process(take(config, batch_size=10)[0]))
+
+    assert requests == [["new entry", "new entry", "entry with a current embedding"]]
+    embeddings = updates[0]["embeddings"]
+    assert embeddings["a"][1] is not None and embeddings["b"][1] is None
+    assert [p[2] for p in updates[0]["passages"]["b"]] == ["hb"]
+    assert not has_jobs(config)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+import neighbours
+from neighbours import build_graph, update_graph
+
+
+def normalized(rng, n, d=16):
+    matrix = rng.standard_normal((n, d)).astype(np.float32)
+    return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+
+def assert_same_graph(graph, expected):
+    assert graph["keys"] == expected["keys"]
+    np.testing.assert_array_equal(graph["indices"], expected["indices"])
+    np.testing.assert_allclose(graph["scores"], expected["scores"], rtol=1e-5, atol=1e-6)
+
+
+@pytest.fixture(params=[1, 4])
+def block_size(request, monkeypatch):
+    # also compute the rows in several blocks
+    monkeypatch.setattr(neighbours, "BLOCK_SIZE", request.param)
+
+
+def test_update_with_new_entries(block_size):
+    rng = np.random.default_rng(0)
+    keys = [f"2023-01-{day:02}" for day in range(1, 21)]
+    matrix = normalized(rng, len(keys))
+    graph = build_graph(keys[:15], matrix[:15], k=4)
+
+    assert_same_graph(update_graph(graph, keys, matrix, changed=(), k=4), build_graph(keys, matrix, k=4))
+
+
+def test_update_with_changed_embeddings(block_size):
+    rng = np.random.default_rng(1)
+    keys = [f"2023-01-{day:02}" for day in range(1, 21)]
+    matrix = normalized(rng, len(keys))
+    graph = build_graph(keys, matrix, k=4)
+    matrix[[3, 11]] = normalized(rng, 2)
+
+    updated = update_graph(graph, keys, matrix, changed=[keys[3], keys[11]], k=4)
+
+    assert_same_graph(updated, build_graph(keys, matrix, k=4))
+
+
+def test_update_with_new_and_changed_entries_at_new_positions(block_size):
+    rng = np.random.default_rng(2)
+    keys = [f"2023-01-{day:02}" for day in range(1, 31)]
+    matrix = normalized(rng, len(keys))
+    # entries 5 and 6 are new and shift the rows after them
+    old = [i for i in range(len(keys)) if i not in (5, 6)]
+    graph = build_graph([keys[i] for i in old], matrix[old], k=5)
+    matrix[20] = normalized(rng, 1)[0]
+
+    updated = update_graph(graph, keys, matrix, changed=[keys[20]], k=5)
+
+    assert_same_graph(updated, build_graph(keys, matrix, k=5))
+
+
+def test_removed_entry_builds_the_graph_again():
+    rng = np.random.default_rng(3)
+    keys = [f"2023-01-{day:02}" for day in range(1, 11)]
+    matrix = normalized(rng, len(keys))
+    graph = build_graph(keys, matrix, k=3)
+
+    updated = update_graph(graph, keys[1:], matrix[1:], changed=(), k=3)
+
+    assert_same_graph(updated, build_graph(keys[1:], matrix[1:], k=3))
+
+
+def test_small_diaries():
+    matrix = normalized(np.random.default_rng(4), 2)
+
+    assert build_graph(["a"], matrix[:1], k=5)["indices"].shape == (1, 0)
+    assert_same_graph(update_graph(build_graph(["a"], matrix[:1], k=5), ["a", "b"], matrix, (), k=5),
+                      build_graph(["a", "b"], matrix, k=5))
@@ -0,0 +1,46 @@
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+import openai_tools
+from openai_tools import get_embeddings, split_input
+
+
+def test_split_input_cuts_at_whitespace():
+    text = " ".join(["wort"] * 100)
+
+    chunks = split_input(text, size=50)
+
+    assert all(len(chunk) <= 50 for chunk in chunks)
+    assert " ".join(chunks) == text
+    assert split_input("kurz", size=50) == ["kurz"]
+    assert split_input("x" * 120, size=50) == ["x" * 50, "x" * 50, "x" * 20]
+
+
+class FakeOpenAI:
+    requests = []
+
+    def __init__(self):
+        self.embeddings = self
+
+    def create(self, input, model):
+        FakeOpenAI.requests.append(input)
+        # the length of every input as a one dimensional embedding, in reverse order
+        data = [SimpleNamespace(index=i, embedding=[float(len(text))]) for i, text in enumerate(input)]
+        return SimpleNamespace(data=data[::-1])
+
+
+def test_get_embeddings_chunks_long_texts_and_splits_requests(monkeypatch):
+    monkeypatch.setitem(sys.modules, "openai", SimpleNamespace(OpenAI=FakeOpenAI))
+    monkeypatch.setattr(openai_tools, "MAX_INPUT_CHARS", 10)
+    monkeypatch.setattr(openai_tools, "MAX_REQUEST_CHARS", 15)
+    FakeOpenAI.requests = []
+
+    embeddings = get_embeddings(["abcdefghij klm", "xyz"])
+
+    assert FakeOpenAI.requests == [["abcdefghij", "klm"], ["xyz"]]
+    assert [e.shape for e in embeddings] == [(1, 1), (1, 1)]
+    # weighted by the length of the chunks
+    np.testing.assert_allclose(embeddings[0], [[(10 * 10 + 3 * 3) / 13]])
+    np.testing.assert_allclose(embeddings[1], [[3]])
@@ -0,0 +1,123 @@
+import numpy as np
+import pytest
+
+import passages
+from passages import (
+    indexed_keys,
+    load_passages,
+    passage_vectors,
+    passages_path,
+    save_passages,
+    search_passages,
+    split_passages,
+    update_passage_index,
+)
+
+
+def vector(*values):
+    return np.array(values, dtype=np.float32)
+
+
+def vectors_file(config):
+    return passages_path(config).with_name(str(load_passages(config)["vectors"]))
+
+
+def test_split_passages_at_time_markers_and_blank_lines():
+    first = "Morgens waren wir lange am See und sind bis zur kleinen Insel in der Mitte geschwommen."
+    second = "Abends gab es Pizza bei Anna, danach haben wir noch bis spät in die Nacht Karten gespielt."
+    text = f"-- 09:10 --\n{first}\n\n-- 20:30 --\n{second}\n"
+
+    assert [text[s:e] for s, e in split_passages(text)] == [first, second]
+
+
+def test_search_finds_the_best_passage_per_entry(config):
+    update_passage_index(config, {
+        "2023-01-01": [(0, 10, "h1", vector(1, 0)), (10, 20, "h2", vector(0, 1))],
+        "2023-01-02": [(0, 10, "h3", vector(1, 1))],
+    })
+
+    results = search_passages(config, vector(0, 2), n=2)
+
+    assert [(key, start) for key, start, _, _ in results] == [("2023-01-01", 10), ("2023-01-02", 0)]
+    assert results[0][3] == pytest.approx(1)
+    assert indexed_keys(config) == {"2023-01-01", "2023-01-02"}
+
+
+def test_vectors_are_kept_apart_from_the_index(config):
+    update_passage_index(config, {"a": [(0, 10, "h1", vector(3, 4))]})
+
+    index = load_passages(config)
+    assert "matrix" not in index
+    np.testing.assert_allclose(np.fromfile(vectors_file(config), dtype=np.float32), [0.6, 0.8])
+
+
+def test_updates_append_only_new_vectors(config):
+    update_passage_index(config, {"a": [(0, 10, "h1", vector(1, 0)), (10, 20, "h2", vector(0, 1))]})
+    # the entry grew, its first passage is unchanged and comes without a vector
+    update_passage_index(config, {"a": [(0, 10, "h1", None), (10, 25, "h3", vector(1, 1))]})
+    # another entry with the same text shares the row
+    update_passage_index(config, {"b": [(5, 15, "h1", vector(1, 0))]})
+
+    index = load_passages(config)
+    assert index["keys"].tolist() == ["a", "a", "b"]
+    assert index["hashes"].tolist() == ["h1", "h3", "h1"]
+    assert index["rows"].tolist() == [0, 2, 0]
+    assert vectors_file(config).stat().st_size == 3 * 2 * 4
+
+
+def test_unfinished_append_is_overwritten(config):
+    update_passage_index(config, {"a": [(0, 10, "h1", vector(1, 0))]})
+    with open(vectors_file(config), "ab") as f:
+        f.write(b"left over")
+
+    update_passage_index(config, {"b": [(0, 10, "h2", vector(0, 1))]})
+
+    np.testing.assert_allclose(np.fromfile(vectors_file(config), dtype=np.float32), [1, 0, 0, 1])
+
+
+def test_vectors_are_read_once_and_kept_up_to_date(config, monkeypatch):
+    update_passage_index(config, {"a": [(0, 10, "h1", vector(1, 0))]})
+    reads = []
+    fromfile = np.fromfile
+    monkeypatch.setattr(np, "fromfile", lambda *args, **kwargs: reads.append(args) or fromfile(*args, **kwargs))
+
+    search_passages(config, vector(1, 0))
+    for i in range(20):
+        update_passage_index(config, {f"b{i}": [(0, 10, f"h{i}", vector(i, 1))]})
+    results = search_passages(config, vector(19, 1), n=1)
+
+    assert len(reads) == 1
+    assert results[0][0] == "b19"
+    np.testing.assert_allclose(passage_vectors(config, load_passages(config)), np.fromfile(vectors_file(config), dtype=np.float32).reshape(-1, 2))
+
+
+def test_unused_vectors_are_compacted(config, monkeypatch):
+    monkeypatch.setattr(passages, "COMPACT_ROWS", 4)
+    update_passage_index(config, {str(key): [(0, 10, f"h{key}", vector(key, 1))] for key in range(6)})
+    old = vectors_file(config)
+
+    update_passage_index(config, {str(key): [] for key in range(4)})
+
+    assert not old.exists()
+    assert load_passages(config)["rows"].tolist() == [0, 1]
+    assert [r[0] for r in search_passages(config, vector(5, 1), n=2)] == ["5", "4"]
+
+
+def test_index_with_the_matrix_inside_is_converted(config):
+    save_passages({
+        "keys": np.array(["a", "b"]),
+        "starts": np.array([0, 0], dtype=np.int32),
+        "ends": np.array([10, 10], dtype=np.int32),
+        "hashes": np.array(["h1", "h2"]),
+        "matrix": np.array([[1, 0], [0, 1]], dtype=np.float32),
+    }, config)
+
+    assert [r[0] for r in search_passages(config, vector(0, 1), n=1)] == ["b"]
+    assert "matrix" not in np.load(passages_path(config)).files
+
+
+def test_entries_without_passages_leave_an_empty_index(config):
+    update_passage_index(config, {"a": []})
+
+    assert search_passages(config, vector(1, 0)) is None
+    assert indexed_keys(config) == set()
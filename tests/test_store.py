@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import store
+from store import DiaryStore, manifest_path, partitions_dir, read_manifest
+
+
+def diary(*dates):
+    return pd.DataFrame(
+        {
+            "date": pd.to_datetime(list(dates)),
+            "entry": [f"entry {i}" for i in range(len(dates))],
+            "images": [[] for _ in dates],
+        }
+    )
+
+
+@pytest.fixture
+def old_diary(config):
+    """A diary in the single csv layout, the second entry has no embedding."""
+    df = diary("2022-11-30 22:00", "2022-12-01 08:00", "2022-12-24 18:00", "2023-01-02 09:00")
+    df.loc[0, "images"] = ["images/a.jpg"]
+    df.to_csv(config.get("diary_csv"), index=False)
+    embeddings = np.empty(len(df), dtype=object)
+    embeddings[:] = [np.full((1, 3), i, dtype=np.float32) if i != 1 else None for i in range(len(df))]
+    np.save(config.get("embedding_file"), embeddings)
+    return df
+
+
+def test_migrate_splits_csv_and_embeddings_by_month(config, old_diary):
+    df = DiaryStore().get(config)
+
+    assert sorted(p.name for p in partitions_dir(config).iterdir()) == [
+        "2022-11.csv", "2022-11.npy", "2022-12.csv", "2022-12.npy", "2023-01.csv", "2023-01.npy", "manifest.json",
+    ]
+    assert read_manifest(config) == {
+        "2022-11": {"entries": 1, "version": 1},
+        "2022-12": {"entries": 2, "version": 1},
+        "2023-01": {"entries": 1, "version": 1},
+    }
+    assert df["entry"].tolist() == old_diary["entry"].tolist()
+    assert df["images"].tolist() == [["images/a.jpg"], [], [], []]
+    assert df["embedding"][1] is None
+    for i in (0, 2, 3):
+        np.testing.assert_array_equal(df["embedding"][i], np.full((1, 3), i))
+    # the old files are kept aside
+    assert (partitions_dir(config).parent / "tagebuch.csv.migrated").exists()
+    assert (partitions_dir(config).parent / "embeddings.npy.migrated").exists()
+
+
+def test_save_bumps_only_the_written_months(config, old_diary):
+    diaries = DiaryStore()
+    df = diaries.get(config)
+    df.loc[3, "entry"] = "changed"
+
+    diaries.save(df, config, months={"2023-01"})
+
+    manifest = read_manifest(config)
+    assert manifest["2023-01"] == {"entries": 1, "version": 2}
+    assert manifest["2022-12"] == {"entries": 2, "version": 1}
+    assert DiaryStore().get(config)["entry"].tolist()[-1] == "changed"
+
+
+def test_save_removes_months_without_entries(config, old_diary):
+    diaries = DiaryStore()
+    df = diaries.get(config)
+
+    diaries.save(df[df["date"] >= "2022-12-01"], config, months={"2022-11"})
+
+    assert "2022-11" not in read_manifest(config)
+    assert not (partitions_dir(config) / "2022-11.csv").exists()
+    assert len(DiaryStore().get(config)) == 3
+
+
+def test_range_reads_only_the_months_in_range(config, old_diary, monkeypatch):
+    read = []
+    read_partition = store.read_partition
+    monkeypatch.setattr(store, "read_partition", lambda config, month: read.append(month) or read_partition(config, month))
+
+    df = DiaryStore().get(config, pd.Timestamp("2022-12-10"), pd.Timestamp("2022-12-31"))
+
+    assert read == ["2022-12"]
+    assert df["date"].tolist() == [pd.Timestamp("2022-12-24 18:00")]
+
+
+def test_partition_changed_by_another_store_is_read_again(config, old_diary):
+    first, second = DiaryStore(), DiaryStore()
+    df = first.get(config)
+    second.get(config)
+    df.loc[0, "entry"] = "from the first store"
+
+    first.save(df, config, months={"2022-11"})
+
+    assert second.get(config)["entry"][0] == "from the first store"
+
+
+def test_empty_diary_without_files(config):
+    df = DiaryStore().get(config)
+
+    assert len(df) == 0
+    assert not manifest_path(config).exists()
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from summarize import DAMPING, rank_sentences, summarize_entries
+
+SENTENCES = [
+    "Wir waren am See schwimmen.",
+    "Das Wasser im See war kalt.",
+    "Abends gab es Pizza am See.",
+    "Die Pizza war kalt.",
+    "Morgen fahre ich nach Berlin.",
+    "Completely unrelated words here.",
+]
+
+
+def dense_textrank(sentences):
+    """TextRank with the full similarity matrix, as a reference."""
+    vectors = TfidfVectorizer().fit_transform(sentences)
+    similarity = (vectors @ vectors.T).toarray()
+    np.fill_diagonal(similarity, 0)
+    weights = similarity.sum(axis=1, keepdims=True)
+    transition = np.where(weights > 0, similarity / np.maximum(weights, 1e-12), 1 / len(sentences))
+    scores = np.full(len(sentences), 1 / len(sentences))
+    for _ in range(200):
+        scores = (1 - DAMPING) / len(sentences) + DAMPING * transition.T @ scores
+    return scores
+
+
+def test_rank_sentences_matches_dense_textrank():
+    np.testing.assert_allclose(rank_sentences(SENTENCES, iterations=200, tol=0), dense_textrank(SENTENCES), atol=1e-9)
+
+
+def test_rank_sentences_without_words():
+    assert rank_sentences(["1 2 3", "4 5 6"]).tolist() == [1, 1]
+    assert rank_sentences(["nur ein Satz"]).tolist() == [1]
+
+
+def test_summarize_entries_keeps_the_budget_and_order():
+    data = pd.DataFrame({"date": pd.to_datetime(["2023-01-01", "2023-01-02"]), "entry": [" ".join(SENTENCES[:3]), " ".join(SENTENCES[3:])]})
+
+    summary = summarize_entries(data, token_budget=20)
+
+    kept = "\n".join(summary["entry"])
+    assert 0 < len(kept) <= 20 * 4
+    positions = [" ".join(SENTENCES).index(s) for s in kept.split("\n")]
+    assert positions == sorted(positions)